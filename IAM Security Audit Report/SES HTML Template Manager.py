@@ -1,5 +1,10 @@
 import boto3
 import json
+import os
+
+# Use the same retry settings as the digest, botocore retries throttled calls and slows down in adaptive mode
+from SecurityAuditDigest import create_client_config
+client_config = create_client_config(os.environ.get('client_retry_mode', 'adaptive'), int(os.environ.get('client_max_attempts', '10')))
 
 # Helper function to read a file
 def read_file(file_path):
@@ -21,7 +26,7 @@ def write_file(content,file_path):
 def create_template(session):
     
      # Create a boto client for ses
-    client = session.client(service_name='ses')
+    client = session.client(service_name='ses', config=client_config)
 
     # Get user input
     template_name = input("HTML Template Name : ")
@@ -47,7 +52,7 @@ def create_template(session):
 def delete_template(session):
 
     # Create a boto client for ses
-    client = session.client(service_name='ses')
+    client = session.client(service_name='ses', config=client_config)
 
     # Get user input
     template_name = input("Template Name : ")
@@ -65,7 +70,7 @@ def delete_template(session):
 def list_templates(session):
     
     # Create a boto client for ses
-    client = session.client(service_name='ses')
+    client = session.client(service_name='ses', config=client_config)
 
     # use boto get get a list of the existing templates
     ses_templates_list = client.list_templates()
@@ -82,7 +87,7 @@ def list_templates(session):
 def get_existing_template(session):
      
     # Create a boto client for ses
-    client = session.client(service_name='ses')
+    client = session.client(service_name='ses', config=client_config)
 
     # Get user input
     template_name = input("Template Name : ")
@@ -111,7 +116,7 @@ def get_existing_template(session):
 def update_template(session):
 
     # Create a boto client for ses
-    client = session.client(service_name='ses')
+    client = session.client(service_name='ses', config=client_config)
 
     # Get user input
     template_name = input("HTML Template Name : ")
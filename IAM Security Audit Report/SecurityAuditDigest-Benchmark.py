@@ -0,0 +1,472 @@
+import os
+import sys
+import json
+import time
+import platform
+import random
+import argparse
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+# SecurityAuditDigest reads its settings from the environment variables the first time get_config is called and keeps them after that,
+# benchmarks that change a setting clear the cached config with get_config.cache_clear
+# Fill in default values so the benchmarks can be run from a local machine without any setup
+benchmark_environment = {
+    'display_actionable_only' : 'False',
+    'check_mfa' : 'True',
+    'inactive_user_low' : '30',
+    'inactive_user_high' : '90',
+    'password_age_low' : '60',
+    'password_age_high' : '120',
+    'inactive_key_low' : '30',
+    'inactive_key_high' : '90',
+    'key_age_low' : '90',
+    'key_age_high' : '180'
+}
+for name, value in benchmark_environment.items():
+    os.environ.setdefault(name, value)
+
+import SecurityAuditDigest
+from dateutil import parser
+
+# Run a function the requested number of times and return the best time in seconds
+def time_call(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# Print a benchmark result line
+def print_result(name, seconds, count):
+    print("{:<40} {:>10.2f} ms {:>10.0f} ns/item".format(name, seconds * 1000, seconds / count * 1e9))
+
+# Header row of the credentials report
+report_header = "user,arn,user_creation_time,password_enabled,password_last_used,password_last_changed,password_next_rotation,mfa_active,access_key_1_active,access_key_1_last_rotated,access_key_1_last_used_date,access_key_1_last_used_region,access_key_1_last_used_service,access_key_2_active,access_key_2_last_rotated,access_key_2_last_used_date,access_key_2_last_used_region,access_key_2_last_used_service,cert_1_active,cert_1_last_rotated,cert_2_active,cert_2_last_rotated"
+
+# Build a synthetic credentials report with the requested number of users (plus the root account)
+def generate_credential_report(count, seed=1):
+    rnd = random.Random(seed)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    rows = [report_header, "<root_account>,arn:aws:iam::123456789012:root,2017-01-01T00:00:00+00:00,not_supported,2020-01-01T00:00:00+00:00,not_supported,not_supported,true,false,N/A,N/A,N/A,N/A,false,N/A,N/A,N/A,N/A,false,N/A,false,N/A"]
+
+    for index in range(count):
+        created = now - timedelta(days=rnd.randint(1, 900), seconds=rnd.randint(0, 86400))
+
+        # Pick a date between when the user was created and now
+        def since_created():
+            return (created + timedelta(days=rnd.randint(0, (now - created).days))).isoformat()
+
+        username = "user" + str(index)
+        row = [username, "arn:aws:iam::123456789012:user/" + username, created.isoformat()]
+
+        # Password columns - some users don't have console access and some have never logged in or changed their password
+        if rnd.random() < 0.7:
+            row += ["true",
+                    since_created() if rnd.random() < 0.8 else "no_information",
+                    since_created() if rnd.random() < 0.7 else "N/A",
+                    "N/A"]
+        else:
+            row += ["false", "N/A", "N/A", "N/A"]
+        row.append("true" if rnd.random() < 0.5 else "false")
+
+        # Key columns - most users have a first key, fewer have a second one
+        for key_chance in (0.6, 0.2):
+            if rnd.random() < key_chance:
+                row += ["true" if rnd.random() < 0.85 else "false",
+                        since_created(),
+                        since_created() if rnd.random() < 0.8 else "N/A",
+                        rnd.choice(("us-east-1", "us-west-2", "eu-west-1")),
+                        rnd.choice(("s3", "ec2", "iam", "sts"))]
+            else:
+                row += ["false", "N/A", "N/A", "N/A", "N/A"]
+
+        # Cert columns
+        row += ["false", "N/A", "false", "N/A"]
+        rows.append(",".join(row))
+
+    return "\n".join(rows)
+
+# Build a list of date cells the way they show up in a credentials report, a mix of timestamps and sentinel values
+def generate_date_cells(count, seed=1):
+    rnd = random.Random(seed)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    cells = []
+    for _ in range(count):
+        if rnd.random() < 0.4:
+            cells.append(rnd.choice(('N/A', 'no_information', 'not_supported')))
+        else:
+            cells.append((now - timedelta(days=rnd.randint(0, 900), seconds=rnd.randint(0, 86400))).isoformat())
+    return cells
+
+# Decoder used before the fast path was added, kept here to compare against
+def legacy_convert_to_datetime(item):
+    rtn = None
+    try:
+        rtn = parser.parse(item)
+    except:
+        rtn = None
+    return rtn
+
+# Compare dateutil against the ConvertToDateTime fast path, with a cold and a warm memo cache
+def benchmark_timestamps(count, repeat):
+    cells = generate_date_cells(count)
+
+    def run_legacy():
+        for cell in cells:
+            legacy_convert_to_datetime(cell)
+
+    def run_cold():
+        SecurityAuditDigest.decode_report_timestamp.cache_clear()
+        for cell in cells:
+            SecurityAuditDigest.ConvertToDateTime(cell)
+
+    def run_warm():
+        for cell in cells:
+            SecurityAuditDigest.ConvertToDateTime(cell)
+
+    # Make sure both decoders agree before timing them
+    for cell in cells:
+        assert legacy_convert_to_datetime(cell) == SecurityAuditDigest.ConvertToDateTime(cell), cell
+
+    print("Timestamp decoding - " + str(count) + " date cells")
+    legacy = time_call(run_legacy, repeat)
+    cold = time_call(run_cold, repeat)
+    run_warm()
+    warm = time_call(run_warm, repeat)
+    print_result("dateutil parser.parse", legacy, count)
+    print_result("ConvertToDateTime (cold cache)", cold, count)
+    print_result("ConvertToDateTime (warm cache)", warm, count)
+    print("Speedup (cold cache) : {:.1f}x".format(legacy / cold))
+    print("")
+
+# Models as they were before __slots__ were added, kept here to compare memory use against
+class LegacyPassword(object):
+    def __init__(self):
+        self.Enabled = None
+        self.LastUsed = None
+        self.LastChanged = None
+        self.NextRotation = None
+        self.ActiveMFA = None
+
+class LegacyKey(object):
+    def __init__(self):
+        self.KeyID = None
+        self.Active = None
+        self.LastRotated = None
+        self.LastUsed = None
+        self.RegionLastUsed = None
+        self.ServiceLastUsed = None
+
+class LegacyCert(object):
+    def __init__(self):
+        self.Active = None
+        self.LastRotated = None
+
+class LegacyUser(object):
+    def __init__(self):
+        self.Username = None
+        self.ARN = None
+        self.UserCreation = None
+        self.Password = None
+        self.Keys = []
+        self.Certs = []
+
+# Parse the report into the legacy models the way parse_report_to_models used to, flags are kept as the text from the report
+def legacy_parse_report_to_models(content):
+    users = []
+    for record in content.split("\n")[2:]:
+        row_item = record.split(",")
+
+        current_user = LegacyUser()
+        current_user.Username = row_item[0]
+        current_user.ARN = row_item[1]
+        current_user.UserCreation = SecurityAuditDigest.ConvertToDateTime(row_item[2])
+
+        current_user_password = LegacyPassword()
+        current_user_password.Enabled = row_item[3]
+        current_user_password.LastUsed = SecurityAuditDigest.ConvertToDateTime(row_item[4])
+        current_user_password.LastChanged = SecurityAuditDigest.ConvertToDateTime(row_item[5])
+        current_user_password.NextRotation = SecurityAuditDigest.ConvertToDateTime(row_item[6])
+        current_user_password.ActiveMFA = row_item[7]
+        current_user.Password = current_user_password
+
+        for key_id, first_column in (("Key1", 8), ("Key2", 13)):
+            current_user_key = LegacyKey()
+            current_user_key.KeyID = key_id
+            current_user_key.Active = row_item[first_column]
+            current_user_key.LastRotated = SecurityAuditDigest.ConvertToDateTime(row_item[first_column + 1])
+            current_user_key.LastUsed = SecurityAuditDigest.ConvertToDateTime(row_item[first_column + 2])
+            current_user_key.RegionLastUsed = row_item[first_column + 3]
+            current_user_key.ServiceLastUsed = row_item[first_column + 4]
+            current_user.Keys.append(current_user_key)
+
+        for first_column in (18, 20):
+            current_cert = LegacyCert()
+            current_cert.Active = row_item[first_column]
+            current_cert.LastRotated = SecurityAuditDigest.ConvertToDateTime(row_item[first_column + 1])
+            current_user.Certs.append(current_cert)
+
+        users.append(current_user)
+    return users
+
+# Measure the memory held by the parsed users with tracemalloc and compare it against the legacy models
+def benchmark_memory(count):
+    content = generate_credential_report(count)
+
+    # Decode the timestamps ahead of time so the memo cache isn't counted against either set of models
+    SecurityAuditDigest.parse_report_to_models(content)
+
+    tracemalloc.start()
+    users = SecurityAuditDigest.parse_report_to_models(content)
+    slots_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # Drop the slot models before measuring the legacy ones so they don't share any strings
+    del users
+
+    tracemalloc.start()
+    legacy_users = legacy_parse_report_to_models(content)
+    legacy_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print("User model memory - " + str(count) + " users")
+    print("{:<40} {:>10.1f} MB {:>10.0f} bytes/user".format("Legacy models (__dict__)", legacy_size / 1e6, legacy_size / count))
+    print("{:<40} {:>10.1f} MB {:>10.0f} bytes/user".format("Slot models", slots_size / 1e6, slots_size / count))
+    print("Saved : {:.1f} MB ({:.0%})".format((legacy_size - slots_size) / 1e6, 1 - slots_size / legacy_size))
+    print("")
+
+# Row renderers as they were before the rows were written with f-strings, kept here to compare against
+def legacy_generate_access_level_rows(rules):
+    temp_list = []
+    for user in rules.Users:
+        temp = '''<tr align="center">
+                <td>''' + rules.get_display_name(user) + '''</td>
+                <td>'''+ SecurityAuditDigest.format_flag(user.Password.Enabled) +'''</td>
+                <td>''' + SecurityAuditDigest.format_flag(user.Keys[0].Active) + '''</td>
+                <td>''' + SecurityAuditDigest.format_flag(user.Keys[1].Active) + '''</td>
+            </tr>
+            '''
+        temp_list.append(temp)
+    return ''.join(temp_list)
+
+def legacy_generate_key_rows(rules, rule):
+    temp_list = []
+    statuses = SecurityAuditDigest.get_displayed_statuses(SecurityAuditDigest.get_config())
+    for finding in rules.evaluate_rules()[rule]:
+        if statuses is None or finding.Status in statuses:
+            temp = '''<tr align="center">
+                    '''+ SecurityAuditDigest.threshold_cells[finding.Status] +'''
+                    <td>'''+ rules.get_display_name(finding.User) +'''</td>
+                    <td>'''+ finding.Key.KeyID +'''</td>
+                    <td>'''+ finding.Recommendation +'''</td>
+                </tr>'''
+            temp_list.append(temp)
+    return ''.join(temp_list)
+
+# Compare the f-string rows against string concatenation for the access levels table and a key rule table
+def benchmark_rendering(count, repeat):
+    rules = SecurityAuditDigest.Rules(SecurityAuditDigest.parse_report_to_models(generate_credential_report(count)))
+    rules.evaluate_rules()
+    key_rows = len(rules.evaluate_rules()['key_rotation'])
+
+    # Both renderers have to produce the same HTML before they're timed
+    assert legacy_generate_access_level_rows(rules) == rules.generate_access_level_rows()
+    assert legacy_generate_key_rows(rules, 'key_rotation') == rules.generate_key_rotation_rows()
+
+    print("Row rendering - " + str(count) + " users, " + str(key_rows) + " key rotation rows")
+    legacy_access = time_call(lambda: legacy_generate_access_level_rows(rules), repeat)
+    access = time_call(rules.generate_access_level_rows, repeat)
+    legacy_keys = time_call(lambda: legacy_generate_key_rows(rules, 'key_rotation'), repeat)
+    keys = time_call(rules.generate_key_rotation_rows, repeat)
+    print_result("Access levels (concatenation)", legacy_access, count)
+    print_result("Access levels (f-string)", access, count)
+    print_result("Key rotation (concatenation)", legacy_keys, key_rows)
+    print_result("Key rotation (f-string)", keys, key_rows)
+    print("Speedup : {:.1f}x access levels, {:.1f}x key rotation".format(legacy_access / access, legacy_keys / keys))
+    print("")
+
+# Compare the size of the SES template data with pre-rendered HTML rows and with structured rows
+def benchmark_template_data(count):
+    rules = SecurityAuditDigest.Rules(SecurityAuditDigest.parse_report_to_models(generate_credential_report(count)))
+    email = SecurityAuditDigest.Email()
+    sizes = {}
+    for structured in ('False', 'True'):
+        os.environ['structured_template_data'] = structured
+        SecurityAuditDigest.get_config.cache_clear()
+        sizes[structured] = len(email.generate_template_data(None, rules, {"PasswordPolicy": {}}).encode('utf-8'))
+    del os.environ['structured_template_data']
+    SecurityAuditDigest.get_config.cache_clear()
+
+    print("Template data size - " + str(count) + " users")
+    print("{:<40} {:>10.1f} KB {:>10.0f} bytes/user".format("HTML rows", sizes['False'] / 1e3, sizes['False'] / count))
+    print("{:<40} {:>10.1f} KB {:>10.0f} bytes/user".format("Structured rows", sizes['True'] / 1e3, sizes['True'] / count))
+    print("Saved : {:.1f} KB ({:.0%})".format((sizes['False'] - sizes['True']) / 1e3, 1 - sizes['True'] / sizes['False']))
+    print("")
+
+# Phases of a digest run, in the order they run
+digest_phases = ('parse', 'evaluate', 'render_rows', 'template_data', 'render_template')
+
+# Run each phase of the digest once on the report and return the seconds and the peak traced memory of each phase
+# Memory is only traced when trace_memory is set since tracemalloc slows everything down
+def run_digest_phases(content, template, trace_memory=False):
+    results = {}
+    state = {}
+
+    def parse():
+        # Start with an empty timestamp cache so every run decodes the report from scratch
+        SecurityAuditDigest.decode_report_timestamp.cache_clear()
+        state['users'] = SecurityAuditDigest.parse_report_to_models(content)
+
+    def evaluate():
+        state['rules'] = SecurityAuditDigest.Rules(state['users'])
+        state['rules'].evaluate_rules()
+
+    def render_rows():
+        rules = state['rules']
+        rules.generate_access_level_rows()
+        rules.generate_mfa_enabled_rows()
+        rules.generate_inactive_users_rows()
+        rules.generate_password_rotation_rows()
+        rules.generate_inactive_keys_rows()
+        rules.generate_key_rotation_rows()
+
+    def template_data():
+        state['template_data'] = SecurityAuditDigest.Email().generate_template_data(None, state['rules'], {"PasswordPolicy": {}})
+
+    def render_template():
+        template.render(json.loads(state['template_data']))
+
+    for name, function in zip(digest_phases, (parse, evaluate, render_rows, template_data, render_template)):
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results[name] = (elapsed, peak)
+    return results
+
+# Time every phase of the digest at each report size, the best time of the repeats is kept and the peak memory is
+# measured in a separate run. Returns the results in the format written to the baseline file
+def benchmark_phases(sizes, repeat, trace_memory=True):
+    template_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'AIRL-SecurityReport-EmailTemplate.html')
+    with open(template_path, 'r') as template_file:
+        template = SecurityAuditDigest.compile_template(template_file.read())
+
+    results = {}
+    for count in sizes:
+        content = generate_credential_report(count)
+        timings = {name: {'seconds': None, 'peak_bytes': None} for name in digest_phases}
+        for _ in range(repeat):
+            for name, (elapsed, _) in run_digest_phases(content, template).items():
+                if timings[name]['seconds'] is None or elapsed < timings[name]['seconds']:
+                    timings[name]['seconds'] = elapsed
+        if trace_memory:
+            for name, (_, peak) in run_digest_phases(content, template, trace_memory=True).items():
+                timings[name]['peak_bytes'] = peak
+
+        print("Digest phases - " + str(count) + " users")
+        for name in digest_phases:
+            line = "{:<40} {:>10.2f} ms {:>10.0f} ns/user".format(name, timings[name]['seconds'] * 1000, timings[name]['seconds'] / count * 1e9)
+            if timings[name]['peak_bytes'] is not None:
+                line += " {:>10.1f} MB peak".format(timings[name]['peak_bytes'] / 1e6)
+            print(line)
+        total = sum(timings[name]['seconds'] for name in digest_phases)
+        print("{:<40} {:>10.2f} ms".format("Total", total * 1000))
+        print("")
+        results[str(count)] = timings
+
+    return {
+        'python' : platform.python_version(),
+        'machine' : platform.machine(),
+        'repeat' : repeat,
+        'sizes' : results
+    }
+
+# Print how each phase changed against a baseline file written by an earlier run
+def compare_phases(results, baseline):
+    print("Compared to baseline (python " + baseline['python'] + ")")
+    for count, timings in results['sizes'].items():
+        if count not in baseline['sizes']:
+            continue
+        for name in digest_phases:
+            before = baseline['sizes'][count].get(name)
+            if before is None or before['seconds'] is None:
+                continue
+            after = timings[name]['seconds']
+            line = "{:>8} users {:<26} {:>10.2f} ms -> {:>10.2f} ms {:>+8.1%}".format(count, name, before['seconds'] * 1000, after * 1000, after / before['seconds'] - 1)
+            if before['peak_bytes'] and timings[name]['peak_bytes']:
+                line += " {:>+8.1%} memory".format(timings[name]['peak_bytes'] / before['peak_bytes'] - 1)
+            print(line)
+    print("")
+
+# Measure how long it takes to import SecurityAuditDigest in a fresh interpreter with python -X importtime
+# This is the part of a Lambda cold start the code controls, so it's worth checking after adding an import
+def benchmark_import_time(top):
+    script_directory = os.path.dirname(os.path.abspath(__file__))
+    environment = dict(os.environ)
+    environment.update(benchmark_environment)
+
+    # Run the import once first so the timing doesn't include compiling the module
+    command = [sys.executable, '-X', 'importtime', '-c', 'import SecurityAuditDigest']
+    subprocess.run(command, cwd=script_directory, env=environment, capture_output=True, check=True)
+    result = subprocess.run(command, cwd=script_directory, env=environment, capture_output=True, text=True, check=True)
+
+    # Each line looks like "import time:  self [us] | cumulative | imported package"
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative_time, module_name = line[len('import time:'):].split('|')
+        imports.append((int(self_time), int(cumulative_time), module_name.strip()))
+
+    total = next(cumulative_time for _, cumulative_time, module_name in reversed(imports) if module_name == 'SecurityAuditDigest')
+    print("Import time - SecurityAuditDigest")
+    print("{:<40} {:>10.2f} ms".format("Total (cumulative)", total / 1000))
+    for self_time, cumulative_time, module_name in sorted(imports, reverse=True)[:top]:
+        print("{:<40} {:>10.2f} ms self {:>10.2f} ms cumulative".format(module_name, self_time / 1000, cumulative_time / 1000))
+    print("")
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Micro-benchmarks for SecurityAuditDigest")
+    argument_parser.add_argument('--count', type=int, default=100000, help="Number of items to run through each benchmark")
+    argument_parser.add_argument('--repeat', type=int, default=3, help="Number of times to run each benchmark, the best time is reported")
+    argument_parser.add_argument('--memory-users', type=int, default=100000, help="Number of users in the report used to measure model memory")
+    argument_parser.add_argument('--template-users', type=int, default=1000, help="Number of users in the report used to measure the SES template data size")
+    argument_parser.add_argument('--import-time', action='store_true', help="Only measure the time it takes to import SecurityAuditDigest")
+    argument_parser.add_argument('--phases', action='store_true', help="Only time each phase of the digest on synthetic reports of every size in --sizes")
+    argument_parser.add_argument('--sizes', default='1000,10000,100000,1000000', help="Comma separated report sizes (users) for --phases")
+    argument_parser.add_argument('--skip-memory', action='store_true', help="Don't measure the peak memory of each phase with --phases")
+    argument_parser.add_argument('--save-baseline', help="Write the --phases results to this JSON file")
+    argument_parser.add_argument('--compare', help="Compare the --phases results against a JSON file written with --save-baseline")
+    args = argument_parser.parse_args()
+
+    if args.import_time:
+        benchmark_import_time(10)
+        return
+
+    if args.phases:
+        sizes = [int(size) for size in args.sizes.split(',')]
+        results = benchmark_phases(sizes, args.repeat, trace_memory=not args.skip_memory)
+        if args.compare:
+            with open(args.compare, 'r') as baseline_file:
+                compare_phases(results, json.load(baseline_file))
+        if args.save_baseline:
+            with open(args.save_baseline, 'w') as baseline_file:
+                json.dump(results, baseline_file, indent=4)
+        return
+
+    benchmark_timestamps(args.count, args.repeat)
+    benchmark_memory(args.memory_users)
+    benchmark_rendering(args.count, args.repeat)
+    benchmark_template_data(args.template_users)
+
+if __name__ == "__main__": main()
@@ -1,556 +1,2543 @@
 import os
-import boto3
 from datetime import datetime, timedelta, timezone
-import base64
-from dateutil import parser
-import calendar
+import concurrent.futures
+import csv
+import functools
+import hashlib
+import html
+import io
 import json
+import operator
+import posixpath
+import random
+import re
+import sys
+import threading
 import time
+import typing
 
-# Flag to only write warning and violation records, ignore writing good records
-display_actionable_only = os.environ['display_actionable_only']
+# boto3, botocore, dateutil, numpy, sqlite3 and calendar are imported the first time they are needed instead of when the
+# Lambda starts, which keeps the cold start short. Check the import time with SecurityAuditDigest-Benchmark.py --import-time
 
 # HTML Table cells with coloring set depending on status
 threshold_cell_good = '<td bgcolor="#4CA64C">Good</td>'
 threshold_cell_warning = '<td bgcolor="#ffff4c">Warning</td>'
 threshold_cell_violation = '<td bgcolor="#ff3232">Violation</td>'
 
-# Pick up values from environment variables
-
 # Rule Evaluation
 # -------------------- #
 # Good : Value < low_threshold
 # Warning : Value > low_threshold and Value < high_threshold
 # Violation : Value > high_threshold 
 
-# Flag to run the rule that checks Active MFA on accounts
-check_mfa = os.environ['check_mfa']
+# Settings picked up from the environment variables, parsed once by get_config
+class AuditConfig(typing.NamedTuple):
+    # Flag to only write warning and violation records, ignore writing good records
+    display_actionable_only: bool
+
+    # Flag to run the rule that checks Active MFA on accounts
+    check_mfa: bool
+
+    # Low and high thresholds for Inactive users check
+    inactive_user_low: int
+    inactive_user_high: int
+
+    # Low and high thresholds for password age check
+    password_age_low: int
+    password_age_high: int
+
+    # Low and high thresholds for inactive key check
+    inactive_key_low: int
+    inactive_key_high: int
+
+    # Low and high thresholds for key age check
+    key_age_low: int
+    key_age_high: int
+
+    # SES settings used to send the digest
+    recipent_email_address: typing.Optional[str]
+    ses_source_email: typing.Optional[str]
+    ses_template_name: typing.Optional[str]
+    ses_region_name: typing.Optional[str]
+
+    # Maximum number of seconds to wait for IAM to generate the credentials report (optional, defaults to 60)
+    report_wait_timeout: float
+
+    # Seconds to wait before checking on the credentials report again, doubled after each check up to the max (optional, defaults to 0.5 and 5)
+    report_poll_initial_delay: float
+    report_poll_max_delay: float
+
+    # Where to cache the credentials report between runs: none, memory, tmp, file:<directory> or s3://<bucket>/<key> (optional, defaults to memory)
+    report_cache: str
+
+    # Endpoint to use for an S3 compatible report cache (optional, defaults to AWS S3)
+    report_cache_endpoint_url: typing.Optional[str]
+
+    # Seconds a cached credentials report is used before checking IAM for a new one, IAM only generates a new report every 4 hours (optional, defaults to 14400)
+    report_cache_max_age: float
+
+    # Flag to only report findings that are new, escalated, improved or resolved since the last run (optional, defaults to False)
+    delta_audit: bool
+
+    # Path of the SQLite database that holds the findings from the last run (optional, defaults to /tmp/security-audit-state.sqlite3)
+    delta_state_path: str
 
-# Low threshold for Inactive users check
-inactive_user_low = int(os.environ['inactive_user_low'])
+    # Role ARNs to assume and audit, each account is merged into one digest (optional, defaults to only auditing this account)
+    audit_role_arns: typing.Tuple[str, ...]
 
-# High threshold for inactive users check
-inactive_user_high = int(os.environ['inactive_user_high'])
+    # Number of accounts to audit at the same time (optional, defaults to 8)
+    audit_max_workers: int
 
-# Low threshold for password age check
-password_age_low = int(os.environ['password_age_low'])
+    # Seconds an account audit can run before it's left out of the digest (optional, defaults to 120)
+    audit_account_timeout: float
 
-# High threshold for password age check
-password_age_high = int(os.environ['password_age_high'])
+    # Session name used when assuming the audit roles (optional, defaults to SecurityAuditDigest)
+    audit_role_session_name: str
 
-# Low threshold for inactive key check
-inactive_key_low = int(os.environ['inactive_key_low'])
+    # Maximum number of connections each boto client keeps open (optional, defaults to 20)
+    client_max_pool_connections: int
 
-# High threshold for inactive key check
-inactive_key_high = int(os.environ['inactive_key_high'])
+    # botocore retry mode used by every client : adaptive (retries with client side rate limiting), standard or legacy (optional, defaults to adaptive)
+    client_retry_mode: str
 
-# Low threshold for key age check
-key_age_low = int(os.environ['key_age_low'])
+    # Maximum number of attempts botocore makes for each AWS call, including the first one (optional, defaults to 10)
+    client_max_attempts: int
 
-# High threshold for key age check
-key_age_high = int(os.environ['key_age_high'])
+    # Flag to evaluate the threshold rules with numpy arrays instead of one user at a time (optional, defaults to False)
+    columnar_evaluation: bool
+
+    # Flag to send the table rows as JSON arrays for the {{#each}} email template instead of pre-rendered HTML (optional, defaults to False)
+    structured_template_data: bool
+
+    # Template data larger than this many bytes is split into several emails (optional, defaults to 250000)
+    ses_max_template_data_bytes: int
+
+    # Number of emails to send at the same time when the report is split (optional, defaults to 2)
+    ses_send_max_workers: int
+
+    # Number of times to try sending an email when SES throttles the request (optional, defaults to 5)
+    ses_send_max_attempts: int
+
+    # Flag to log the run's phase timings and counts as a CloudWatch Embedded Metric Format line (optional, defaults to True)
+    emit_metrics: bool
+
+    # CloudWatch namespace the metrics are published to (optional, defaults to SecurityAuditDigest)
+    metrics_namespace: str
+
+    # Profilers to run : cpu (cProfile) and/or memory (tracemalloc), comma separated (optional, defaults to none)
+    profiler: typing.Tuple[str, ...]
+
+    # Phases to profile : handler, report, parse, rules, template_data and/or send, comma separated (optional, defaults to handler)
+    profiler_phases: typing.Tuple[str, ...]
+
+    # Directory the profiles are written to (optional, defaults to /tmp)
+    profiler_output_dir: str
+
+    # Number of functions and allocation sites to log for each profile (optional, defaults to 20)
+    profiler_top: int
+
+    # Thresholds for users under an IAM path or with a tag, a JSON list or the path of a JSON file (optional, defaults to none)
+    threshold_overrides: typing.Optional[str]
+
+    # Flag to look up each user's groups, policies and tags with get_account_authorization_details (optional, defaults to False)
+    enrich_users: bool
+
+    # Flag to check keys flagged by the inactive key rule against IAM in case they were used after the report was generated (optional, defaults to False)
+    refresh_flagged_keys: bool
+
+    # IAM calls per second, number of calls, seconds and threads the key refresh can use (optional, defaults to 10, 200, 20 and 4)
+    key_refresh_rate: float
+    key_refresh_max_calls: int
+    key_refresh_timeout: float
+    key_refresh_max_workers: int
+
+    # Act on violations : off, dry_run (only log what would be done) or apply (optional, defaults to off)
+    remediation_mode: str
+
+    # Rules whose violations are remediated : inactive_keys and/or inactive_users, comma separated (optional, defaults to inactive_keys)
+    remediation_rules: typing.Tuple[str, ...]
+
+    # Usernames and IAM paths (starting with /) that can be remediated, and ones that never are, comma separated (optional, defaults to none)
+    remediation_allow_list: typing.Tuple[str, ...]
+    remediation_exempt_list: typing.Tuple[str, ...]
+
+    # IAM calls per second, burst size, number of calls, seconds and threads the remediation can use (optional, defaults to 10, 20, 5000, 600 and 8)
+    remediation_rate: float
+    remediation_burst: int
+    remediation_max_calls: int
+    remediation_timeout: float
+    remediation_max_workers: int
+
+    # File the remediation audit log is appended to as JSON lines, it's always written to the Lambda log too (optional, defaults to /tmp/security-audit-remediation.jsonl)
+    remediation_log_path: typing.Optional[str]
+
+    # Directory each parsed credentials report is saved to as numpy columns, partitioned by date, requires numpy (optional, defaults to none)
+    history_path: typing.Optional[str]
+
+# Convert a True/False setting into a boolean
+def parse_flag(value):
+    return value.strip().lower() == 'true'
+
+# Convert a comma separated setting into a tuple, blank entries are dropped
+def parse_list(value):
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+# Read the settings from the environment variables the first time they are needed, later calls return the same config
+@functools.lru_cache(maxsize=None)
+def get_config():
+    environ = os.environ
+    return AuditConfig(
+        display_actionable_only = parse_flag(environ['display_actionable_only']),
+        check_mfa = parse_flag(environ['check_mfa']),
+        inactive_user_low = int(environ['inactive_user_low']),
+        inactive_user_high = int(environ['inactive_user_high']),
+        password_age_low = int(environ['password_age_low']),
+        password_age_high = int(environ['password_age_high']),
+        inactive_key_low = int(environ['inactive_key_low']),
+        inactive_key_high = int(environ['inactive_key_high']),
+        key_age_low = int(environ['key_age_low']),
+        key_age_high = int(environ['key_age_high']),
+        recipent_email_address = environ.get('recipent_email_address'),
+        ses_source_email = environ.get('ses_source_email'),
+        ses_template_name = environ.get('ses_template_name'),
+        ses_region_name = environ.get('ses_region_name'),
+        report_wait_timeout = float(environ.get('report_wait_timeout', '60')),
+        report_poll_initial_delay = float(environ.get('report_poll_initial_delay', '0.5')),
+        report_poll_max_delay = float(environ.get('report_poll_max_delay', '5')),
+        report_cache = environ.get('report_cache', 'memory'),
+        report_cache_endpoint_url = environ.get('report_cache_endpoint_url'),
+        report_cache_max_age = float(environ.get('report_cache_max_age', '14400')),
+        delta_audit = parse_flag(environ.get('delta_audit', 'False')),
+        delta_state_path = environ.get('delta_state_path', '/tmp/security-audit-state.sqlite3'),
+        audit_role_arns = parse_list(environ.get('audit_role_arns', '')),
+        audit_max_workers = int(environ.get('audit_max_workers', '8')),
+        audit_account_timeout = float(environ.get('audit_account_timeout', '120')),
+        audit_role_session_name = environ.get('audit_role_session_name', 'SecurityAuditDigest'),
+        client_max_pool_connections = int(environ.get('client_max_pool_connections', '20')),
+        client_retry_mode = environ.get('client_retry_mode', 'adaptive').strip().lower(),
+        client_max_attempts = int(environ.get('client_max_attempts', '10')),
+        columnar_evaluation = parse_flag(environ.get('columnar_evaluation', 'False')),
+        structured_template_data = parse_flag(environ.get('structured_template_data', 'False')),
+        ses_max_template_data_bytes = int(environ.get('ses_max_template_data_bytes', '250000')),
+        ses_send_max_workers = int(environ.get('ses_send_max_workers', '2')),
+        ses_send_max_attempts = int(environ.get('ses_send_max_attempts', '5')),
+        emit_metrics = parse_flag(environ.get('emit_metrics', 'True')),
+        metrics_namespace = environ.get('metrics_namespace', 'SecurityAuditDigest'),
+        profiler = parse_list(environ.get('profiler', '')),
+        profiler_phases = parse_list(environ.get('profiler_phases', 'handler')),
+        profiler_output_dir = environ.get('profiler_output_dir', '/tmp'),
+        profiler_top = int(environ.get('profiler_top', '20')),
+        threshold_overrides = environ.get('threshold_overrides') or None,
+        enrich_users = parse_flag(environ.get('enrich_users', 'False')),
+        refresh_flagged_keys = parse_flag(environ.get('refresh_flagged_keys', 'False')),
+        key_refresh_rate = float(environ.get('key_refresh_rate', '10')),
+        key_refresh_max_calls = int(environ.get('key_refresh_max_calls', '200')),
+        key_refresh_timeout = float(environ.get('key_refresh_timeout', '20')),
+        key_refresh_max_workers = int(environ.get('key_refresh_max_workers', '4')),
+        remediation_mode = environ.get('remediation_mode', 'off').strip().lower(),
+        remediation_rules = parse_list(environ.get('remediation_rules', 'inactive_keys')),
+        remediation_allow_list = parse_list(environ.get('remediation_allow_list', '')),
+        remediation_exempt_list = parse_list(environ.get('remediation_exempt_list', '')),
+        remediation_rate = float(environ.get('remediation_rate', '10')),
+        remediation_burst = int(environ.get('remediation_burst', '20')),
+        remediation_max_calls = int(environ.get('remediation_max_calls', '5000')),
+        remediation_timeout = float(environ.get('remediation_timeout', '600')),
+        remediation_max_workers = int(environ.get('remediation_max_workers', '8')),
+        remediation_log_path = environ.get('remediation_log_path', '/tmp/security-audit-remediation.jsonl') or None,
+        history_path = environ.get('history_path') or None
+    )
+
+# numpy is optional, it's only needed when columnar_evaluation is turned on (add it to the Lambda with a layer)
+# It's imported by import_numpy the first time columnar evaluation runs
+numpy = None
+
+# Import numpy if it's installed, returns None if it isn't
+def import_numpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as numpy_module
+        except ImportError:
+            return None
+        numpy = numpy_module
+    return numpy
+
+# Run metrics
+# -------------------- #
+# Phase timings and counts collected during a run, logged as one CloudWatch Embedded Metric Format (EMF) line at the end
+# CloudWatch turns the line into metrics on its own, so dashboards don't need any extra API calls
+# Phases can be recorded from several threads (ex. one per account), the times of a phase are added together
+class RunMetrics(object):
+    def __init__(self):
+        self.Lock = threading.Lock()
+        self.Phases = {}
+        self.Counts = {}
+        self.Calls = {}
+
+    # Add the seconds a phase took
+    def add_phase(self, name, seconds):
+        with self.Lock:
+            self.Phases[name] = self.Phases.get(name, 0.0) + seconds
+
+    # Add to a count
+    def add_count(self, name, value):
+        with self.Lock:
+            self.Counts[name] = self.Counts.get(name, 0) + value
+
+    # Add an AWS call made by one of the clients, operation is <service>.<Operation> (ex. ses.SendTemplatedEmail)
+    # Each operation keeps [calls, retries, throttled, errors, total seconds, slowest seconds]
+    def add_call(self, operation, seconds, retries, error_code):
+        with self.Lock:
+            call = self.Calls.get(operation)
+            if call is None:
+                call = self.Calls[operation] = [0, 0, 0, 0, 0.0, 0.0]
+            call[0] += 1
+            call[1] += retries
+            if error_code in throttling_error_codes:
+                call[2] += 1
+            elif error_code is not None:
+                call[3] += 1
+            call[4] += seconds
+            call[5] = max(call[5], seconds)
+
+    # Build the EMF log line, phases are reported in milliseconds as <Phase>Time
+    # The AWS calls are added up into ApiCalls, ApiRetries, ApiThrottles and ApiErrors
+    def format_emf(self, namespace, function_name):
+        with self.Lock:
+            values = {name + 'Time' : round(seconds * 1000, 3) for name, seconds in self.Phases.items()}
+            metrics = [{'Name' : name, 'Unit' : 'Milliseconds'} for name in values]
+            for name, value in self.Counts.items():
+                values[name] = value
+                metrics.append({'Name' : name, 'Unit' : 'Bytes' if name.endswith('Bytes') else 'Count'})
+            if self.Calls:
+                for index, name in enumerate(('ApiCalls', 'ApiRetries', 'ApiThrottles', 'ApiErrors')):
+                    values[name] = sum(call[index] for call in self.Calls.values())
+                    metrics.append({'Name' : name, 'Unit' : 'Count'})
+
+        return format_emf_line(namespace, ['FunctionName'], {'FunctionName' : function_name}, metrics, values)
+
+    # Build one EMF log line for each AWS operation with an Operation dimension, so retries and latency can be compared
+    # against the service limits of each call
+    def format_call_emf(self, namespace, function_name):
+        metrics = [{'Name' : 'Calls', 'Unit' : 'Count'}, {'Name' : 'Retries', 'Unit' : 'Count'}, {'Name' : 'Throttles', 'Unit' : 'Count'},
+            {'Name' : 'Errors', 'Unit' : 'Count'}, {'Name' : 'AverageLatency', 'Unit' : 'Milliseconds'}, {'Name' : 'MaxLatency', 'Unit' : 'Milliseconds'}]
+        lines = []
+        with self.Lock:
+            for operation, (calls, retries, throttles, errors, seconds, slowest) in sorted(self.Calls.items()):
+                values = {'Calls' : calls, 'Retries' : retries, 'Throttles' : throttles, 'Errors' : errors,
+                    'AverageLatency' : round(seconds / calls * 1000, 3), 'MaxLatency' : round(slowest * 1000, 3)}
+                lines.append(format_emf_line(namespace, ['FunctionName', 'Operation'], {'FunctionName' : function_name, 'Operation' : operation}, metrics, values))
+        return lines
+
+    # One line per AWS operation for the log : calls, retries, throttles, errors and latency
+    def format_call_summary(self):
+        with self.Lock:
+            return ["API calls - {} : {} call(s), {} retries, {} throttled, {} error(s), {:.1f}ms average, {:.1f}ms max".format(
+                operation, calls, retries, throttles, errors, seconds / calls * 1000, slowest * 1000)
+                for operation, (calls, retries, throttles, errors, seconds, slowest) in sorted(self.Calls.items())]
+
+# Build an EMF log line with the dimensions and metric values
+def format_emf_line(namespace, dimensions, dimension_values, metrics, values):
+    line = {
+        '_aws' : {
+            'Timestamp' : int(time.time() * 1000),
+            'CloudWatchMetrics' : [{
+                'Namespace' : namespace,
+                'Dimensions' : [dimensions],
+                'Metrics' : metrics
+            }]
+        }
+    }
+    line.update(dimension_values)
+    line.update(values)
+    return json.dumps(line, separators=(',', ':'))
+
+# Metrics for the current run, lambda_handler starts a new one for each invocation
+run_metrics = RunMetrics()
+
+# Profiling
+# -------------------- #
+# Set profiler to cpu and/or memory to profile the phases listed in profiler_phases. Each profile is written to profiler_output_dir
+# and the top functions / allocation sites are logged. When profiler isn't set run_profiled just calls the function
+
+# Only one phase is profiled at a time, a phase that runs inside a profiled phase (ex. parse inside handler) is left to the outer profile
+profiling_active = threading.Lock()
+
+def run_profiled(phase, function, *args, **kwargs):
+    config = get_config()
+    if not config.profiler or phase not in config.profiler_phases or not profiling_active.acquire(blocking=False):
+        return function(*args, **kwargs)
+
+    try:
+        return run_with_profilers(config, phase, function, args, kwargs)
+    finally:
+        profiling_active.release()
+
+def run_with_profilers(config, phase, function, args, kwargs):
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    profile_path = os.path.join(config.profiler_output_dir, 'profile-' + phase + '-' + time.strftime('%Y%m%dT%H%M%S'))
+    cpu_profile = cProfile.Profile() if 'cpu' in config.profiler else None
+    trace_memory = 'memory' in config.profiler
+
+    if trace_memory:
+        tracemalloc.start()
+    if cpu_profile is not None:
+        cpu_profile.enable()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        # Stop both profilers before writing anything so the profiles don't include their own output
+        if cpu_profile is not None:
+            cpu_profile.disable()
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        if cpu_profile is not None:
+            cpu_profile.dump_stats(profile_path + '.pstats')
+            summary = io.StringIO()
+            pstats.Stats(cpu_profile, stream=summary).sort_stats('cumulative').print_stats(config.profiler_top)
+            print("CPU profile - " + phase + " written to " + profile_path + ".pstats")
+            print(summary.getvalue())
+
+        # The allocation sites are the lines holding the most memory when the phase finished
+        if trace_memory:
+            lines = ["Memory profile - {} : {:.1f} MB peak, {:.1f} MB still allocated".format(phase, peak / 1e6, current / 1e6)]
+            lines.extend(str(statistic) for statistic in snapshot.statistics('lineno')[:config.profiler_top])
+            with open(profile_path + '-memory.txt', 'w') as memory_file:
+                memory_file.write('\n'.join(lines) + '\n')
+            print("Memory profile - " + phase + " written to " + profile_path + "-memory.txt")
+            print('\n'.join(lines))
 
 # Model objects to parse file into 
+# The models use __slots__ instead of a per instance __dict__ because a report can have tens of thousands of users
+# Flags (Enabled, Active, ActiveMFA) are stored as booleans, they are converted from the report's true/false text when it's parsed
 class Password(object):
-    def __init__(self):
-        self.Enabled = None
-        self.LastUsed = None
-        self.LastChanged = None
-        self.NextRotation = None
-        self.ActiveMFA = None
+    __slots__ = ('Enabled', 'LastUsed', 'LastChanged', 'NextRotation', 'ActiveMFA')
+
+    def __init__(self, enabled=None, last_used=None, last_changed=None, next_rotation=None, active_mfa=None):
+        self.Enabled = enabled
+        self.LastUsed = last_used
+        self.LastChanged = last_changed
+        self.NextRotation = next_rotation
+        self.ActiveMFA = active_mfa
 
 class Key(object):
-    def __init__(self):
-        self.KeyID = None
-        self.Active = None
-        self.LastRotated = None
-        self.LastUsed = None
-        self.RegionLastUsed = None
-        self.ServiceLastUsed = None
+    __slots__ = ('KeyID', 'Active', 'LastRotated', 'LastUsed', 'RegionLastUsed', 'ServiceLastUsed')
+
+    def __init__(self, key_id=None, active=None, last_rotated=None, last_used=None, region_last_used=None, service_last_used=None):
+        self.KeyID = key_id
+        self.Active = active
+        self.LastRotated = last_rotated
+        self.LastUsed = last_used
+        self.RegionLastUsed = region_last_used
+        self.ServiceLastUsed = service_last_used
 
 class Cert(object):
-    def __init__(self):
-        self.Active = None
-        self.LastRotated = None
+    __slots__ = ('Active', 'LastRotated')
+
+    def __init__(self, active=None, last_rotated=None):
+        self.Active = active
+        self.LastRotated = last_rotated
 
+# RowHash is a hash of the user's row in the credentials report, used to tell if anything about the user changed between runs
+# Groups, policies and tags aren't in the credentials report, they're None unless they've been looked up from IAM (see enrich_users)
 class User(object):
-    def __init__(self):
-        self.Username = None
-        self.ARN = None
-        self.UserCreation = None
-        self.Password = None
-        self.Keys = []
-        self.Certs = []
+    __slots__ = ('Username', 'ARN', 'UserCreation', 'Password', 'Keys', 'Certs', 'RowHash', 'Tags', 'Groups', 'Policies')
+
+    def __init__(self, username=None, arn=None, user_creation=None, password=None, keys=None, certs=None, row_hash=None, tags=None, groups=None, policies=None):
+        self.Username = username
+        self.ARN = arn
+        self.UserCreation = user_creation
+        self.Password = password
+        self.Keys = keys if keys is not None else []
+        self.Certs = certs if certs is not None else []
+        self.RowHash = row_hash
+        self.Tags = tags
+        self.Groups = groups
+        self.Policies = policies
+
+# Convert a true/false value from the credentials report into a boolean, anything other than false counts as true
+def ConvertToBool(item):
+    return item != 'false'
+
+# Convert a boolean flag back into the true/false text used by the credentials report
+def format_flag(value):
+    if value:
+        return 'true'
+    return 'false'
+
+# Values the credentials report uses in date fields that don't apply to a user
+report_date_sentinels = frozenset(('N/A', 'no_information', 'not_supported', ''))
+
+# Decode a date field from the credentials report. The report writes dates in a fixed ISO-8601 format (2019-01-10T16:42:21+00:00)
+# so they can be read with datetime.fromisoformat, dateutil is only used for anything that isn't in that format
+# Many users share the same timestamps (ex. accounts created together) so decoded values are memoized
+@functools.lru_cache(maxsize=65536)
+def decode_report_timestamp(item):
+    # Sentinel values are checked first so they don't have to raise and catch an exception
+    if item in report_date_sentinels:
+        return None
+    try:
+        return datetime.fromisoformat(item)
+    except ValueError:
+        pass
+    from dateutil import parser
+    try:
+        return parser.parse(item)
+    except (ValueError, OverflowError):
+        return None
 
 # Conversion utility that attempts to parse the provided value as a datetime and if it's unable to it will provide a None value
 # We do this because the file uses text such as N/A as values in date fields that don't apply to it
 def ConvertToDateTime(item):
-    rtn = None
-    try:
-        rtn = parser.parse(item)
-    except:
-        rtn = None
-    return rtn
+    if not isinstance(item, str):
+        return None
+    return decode_report_timestamp(item)
+
+# Sessions and clients are kept at the module level so a warm Lambda container reuses them instead of loading the endpoint
+# and service model data again on every invocation
+# Sessions created by create_boto_session, keyed by (profile_name, region_name)
+boto_sessions = {}
+
+# Clients created for the sessions above, keyed by (profile_name, region_name, service_name, endpoint_url)
+boto_clients = {}
+
+# (profile_name, region_name) of each session in boto_sessions, looked up by the id of the session
+boto_session_keys = {}
+
+# Number of times a client was found in the registry (hits) or had to be created (misses)
+client_registry_stats = {'hits' : 0, 'misses' : 0}
+
+# Creating clients from a session isn't thread safe, so the registry is only changed while holding this lock
+client_registry_lock = threading.Lock()
+
+# Client settings shared by every client, created by get_client_config the first time a client is made
+client_config = None
+
+# Keep connections open, allow enough of them for the threads that share a client and let botocore retry throttled and
+# failed calls. In adaptive mode botocore also slows down the client's own calls when the service starts throttling them
+# SES HTML Template Manager.py uses this for its clients too
+def create_client_config(retry_mode='adaptive', max_attempts=10, max_pool_connections=10):
+    import botocore.config
+    return botocore.config.Config(
+        max_pool_connections=max_pool_connections,
+        tcp_keepalive=True,
+        retries={'mode' : retry_mode, 'total_max_attempts' : max_attempts}
+    )
+
+def get_client_config():
+    global client_config
+    if client_config is None:
+        config = get_config()
+        client_config = create_client_config(config.client_retry_mode, config.client_max_attempts, config.client_max_pool_connections)
+    return client_config
+
+# Count each AWS call made with the client in the run's metrics : how long it took (including botocore's retries and the
+# time spent waiting on the adaptive rate limiter), how many times it was retried and if it ended throttled or with an error
+def track_client_calls(client):
+    service_name = client.meta.service_model.service_name
+
+    def before_call(model, context, **kwargs):
+        context['audit_call'] = (service_name + '.' + model.name, time.monotonic())
+
+    def after_call(parsed, context, **kwargs):
+        call = context.get('audit_call')
+        if call is None:
+            return
+        operation, start = call
+        run_metrics.add_call(operation, time.monotonic() - start, parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0), parsed.get('Error', {}).get('Code'))
+
+    # Calls that fail without a response (ex. connection errors after the last retry)
+    def after_call_error(exception, context, **kwargs):
+        call = context.get('audit_call')
+        if call is None:
+            return
+        operation, start = call
+        run_metrics.add_call(operation, time.monotonic() - start, 0, type(exception).__name__)
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('after-call', after_call)
+    client.meta.events.register('after-call-error', after_call_error)
+    return client
 
 # Helper function to determine if a profile name or region have been specfied and create the proper instance of a boto session
+# The session is reused for later calls with the same profile and region
 def create_boto_session(profile_name,region_name):
     
-    # default session - Will use default profile and region
-    session = boto3.session.Session()
-    
-    # check what's been provided and create the right instance of session
-    if profile_name is not None and region_name is not None:
-        session = boto3.session.Session(profile_name=profile_name, region_name = region_name)
-    elif profile_name is None and region_name is not None:
-        session = boto3.session.Session(region_name = region_name)
-    elif profile_name is not None and region_name is None:
-        session = boto3.session.Session(profile_name=profile_name)
+    import boto3
+
+    session_key = (profile_name, region_name)
+    with client_registry_lock:
+        session = boto_sessions.get(session_key)
+        if session is not None:
+            return session
+
+        # check what's been provided and create the right instance of session
+        if profile_name is not None and region_name is not None:
+            session = boto3.session.Session(profile_name=profile_name, region_name = region_name)
+        elif profile_name is None and region_name is not None:
+            session = boto3.session.Session(region_name = region_name)
+        elif profile_name is not None and region_name is None:
+            session = boto3.session.Session(profile_name=profile_name)
+        else:
+            # default session - Will use default profile and region
+            session = boto3.session.Session()
+
+        boto_sessions[session_key] = session
+        boto_session_keys[id(session)] = session_key
 
     return session
 
-# Get the credentials report from IAM
-def get_iam_credentials_report(session):
-    
-    # Create a boto client using IAM
-    client = session.client(service_name='iam')
+# Get a client for the service from the registry, creating it the first time it's needed
+# Sessions that didn't come from create_boto_session (ex. assumed role sessions with credentials that expire) get a new client each time
+def get_boto_client(session, service_name, endpoint_url=None):
+    with client_registry_lock:
+        session_key = boto_session_keys.get(id(session))
+        if session_key is None:
+            return track_client_calls(session.client(service_name=service_name, endpoint_url=endpoint_url, config=get_client_config()))
+
+        client_key = session_key + (service_name, endpoint_url)
+        client = boto_clients.get(client_key)
+        if client is not None:
+            client_registry_stats['hits'] += 1
+            return client
+
+        client_registry_stats['misses'] += 1
+        client = track_client_calls(session.client(service_name=service_name, endpoint_url=endpoint_url, config=get_client_config()))
+        boto_clients[client_key] = client
+        return client
+
+# Ask IAM to generate a credentials report and wait until it's ready, returns how many times the report state was checked
+# IAM only regenerates the report every 4 hours so most of the time it's already complete on the first call
+def wait_for_credentials_report(client):
+
+    config = get_config()
+    deadline = time.monotonic() + config.report_wait_timeout
+    delay = config.report_poll_initial_delay
+    checks = 0
+
+    while True:
+        # Generates a credentials report if one isn't already created, the response tells us if it's STARTED, INPROGRESS or COMPLETE
+        response = client.generate_credential_report()
+        checks += 1
+        if response['State'] == 'COMPLETE':
+            return checks
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Credentials report was not ready after " + str(config.report_wait_timeout) + " seconds (state " + response['State'] + ")")
+
+        # Back off between checks, the jitter keeps concurrent runs from checking in lock step
+        time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+        delay = min(delay * 2, config.report_poll_max_delay)
+
+# Credentials report downloaded from IAM along with the time IAM generated it
+# Content is kept as the raw bytes IAM returns, the parser decodes them as it reads the rows
+class CredentialsReport(object):
+    __slots__ = ('GeneratedTime', 'Content')
+
+    def __init__(self, generated_time, content):
+        self.GeneratedTime = generated_time
+        self.Content = content
+
+# Report cache that keeps the last report in memory, this only helps when Lambda reuses a warm container
+class MemoryReportCache(object):
+    def __init__(self):
+        self.Report = None
+
+    def load(self):
+        return self.Report
+
+    def save(self, report):
+        self.Report = report
+
+# Report cache that writes the last report to a local directory (ex. /tmp on Lambda)
+class FileReportCache(object):
+    def __init__(self, directory, name='credentials-report'):
+        self.ContentPath = os.path.join(directory, name + '.csv')
+        self.MetadataPath = os.path.join(directory, name + '.json')
+
+    def load(self):
+        try:
+            with open(self.MetadataPath, 'r') as metadata_file:
+                metadata = json.load(metadata_file)
+            with open(self.ContentPath, 'rb') as content_file:
+                content = content_file.read()
+        except (OSError, ValueError):
+            return None
+        return CredentialsReport(datetime.fromisoformat(metadata['GeneratedTime']), content)
+
+    def save(self, report):
+        os.makedirs(os.path.dirname(self.ContentPath), exist_ok=True)
+        with open(self.ContentPath, 'wb') as content_file:
+            content_file.write(report.Content)
+        # Metadata is written last so a partially written report is never loaded
+        with open(self.MetadataPath, 'w') as metadata_file:
+            json.dump({'GeneratedTime': report.GeneratedTime.isoformat()}, metadata_file)
+
+# Report cache that stores the last report in an S3 (or S3 compatible) bucket, the generated time is kept in the object metadata
+class S3ReportCache(object):
+    def __init__(self, session, bucket, key, endpoint_url=None):
+        self.Client = get_boto_client(session, 's3', endpoint_url)
+        self.Bucket = bucket
+        self.Key = key
+
+    def load(self):
+        try:
+            response = self.Client.get_object(Bucket=self.Bucket, Key=self.Key)
+        except self.Client.exceptions.NoSuchKey:
+            return None
+        generated_time = datetime.fromisoformat(response['Metadata']['generated-time'])
+        return CredentialsReport(generated_time, response['Body'].read())
+
+    def save(self, report):
+        self.Client.put_object(
+            Bucket=self.Bucket,
+            Key=self.Key,
+            Body=report.Content,
+            Metadata={'generated-time': report.GeneratedTime.isoformat()}
+        )
 
-    # Generates a credentials report if one isn't already created (new reports can only be generated only every 4 hrs)
-    client.generate_credential_report()
+# Report caches used by get_credentials_report, created on first use from the report_cache setting
+# Each account audited gets its own cache, the account running the Lambda uses the None entry
+report_caches = {}
+
+# Create the report cache backend from the report_cache setting, account_id is added to the file or key name when it's provided
+# none - no caching, memory - in process, tmp - /tmp, file:<directory> - a local directory, s3://<bucket>/<key> - an S3 object
+def create_report_cache(session, setting, account_id=None):
+    if setting == 'none':
+        return None
+    elif setting == 'memory':
+        return MemoryReportCache()
+
+    name = 'credentials-report'
+    if account_id is not None:
+        name = name + '-' + account_id
+
+    if setting == 'tmp':
+        return FileReportCache('/tmp/iam-credentials-report', name)
+    elif setting.startswith('file:'):
+        return FileReportCache(setting[len('file:'):], name)
+    elif setting.startswith('s3://'):
+        bucket, _, key = setting[len('s3://'):].partition('/')
+        key = key or 'credentials-report.csv'
+        if account_id is not None:
+            key_root, key_extension = posixpath.splitext(key)
+            key = key_root + '-' + account_id + key_extension
+        return S3ReportCache(session, bucket, key, get_config().report_cache_endpoint_url)
+    raise ValueError("Unknown report_cache setting " + setting)
+
+# Get the credentials report from IAM, skipping the download when the cached report is still the current one
+# When auditing another account, account_id picks the cache to use and cache_session is the session used to reach the cache
+def get_credentials_report(session, account_id=None, cache_session=None, client=None):
+
+    config = get_config()
+    if account_id not in report_caches:
+        report_caches[account_id] = create_report_cache(cache_session or session, config.report_cache, account_id)
+    report_cache = report_caches[account_id]
+
+    # IAM won't generate a new report until the current one is 4 hours old, so a cached report younger than that is still current
+    if report_cache is not None:
+        cached_report = report_cache.load()
+        if cached_report is not None and datetime.now(timezone.utc) - cached_report.GeneratedTime < timedelta(seconds=config.report_cache_max_age):
+            print("Credentials report - using cached report generated at " + cached_report.GeneratedTime.isoformat())
+            return cached_report
 
-    # Pause 5 seconds to allow time for the report to be generated
-    time.sleep(5)
+    # Create a boto client using IAM
+    if client is None:
+        client = get_boto_client(session, 'iam')
+
+    # Wait for the report to be generated
+    start = time.monotonic()
+    checks = wait_for_credentials_report(client)
+    generated = time.monotonic()
 
     # Get the credentials report
     credentials_report = client.get_credential_report()
+    downloaded = time.monotonic()
+
+    # The content stays as bytes, decoding a full copy of the report up front would hold the report in memory twice while it's parsed
+    report = CredentialsReport(credentials_report["GeneratedTime"], credentials_report["Content"])
 
-    # Decode credentials file into UTF-8
-    content = credentials_report["Content"].decode('utf-8')
+    print("Credentials report - generate: {:.3f}s ({} checks), download: {:.3f}s".format(generated - start, checks, downloaded - generated))
+    run_metrics.add_phase('ReportGenerate', generated - start)
+    run_metrics.add_phase('ReportDownload', downloaded - generated)
 
+    if report_cache is not None:
+        report_cache.save(report)
+
+    return report
+
+# Get the credentials report from IAM
+def get_iam_credentials_report(session):
     # Return CSV Content of the Credentials file
-    return content
+    return get_credentials_report(session).Content.decode('utf-8')
 
 # Get the password policies using boto 
-def get_account_password_policies(session):
+def get_account_password_policies(session, client=None):
     
     # Create a client to access IAM services
-    client = session.client(service_name='iam')
+    if client is None:
+        client = get_boto_client(session, 'iam')
 
-    # Get the account password policies
-    password_policies = client.get_account_password_policy()
+    # Get the account password policies, accounts that have never set a password policy return NoSuchEntity
+    start = time.monotonic()
+    try:
+        password_policies = client.get_account_password_policy()
+    except client.exceptions.NoSuchEntityException:
+        password_policies = {"PasswordPolicy": {}}
+    run_metrics.add_phase('PasswordPolicy', time.monotonic() - start)
 
     # Return password policies
     return password_policies
 
+# Get the groups, policies and tags of every user in one paginated get_account_authorization_details sweep
+# Returns an index of (groups, policies, tags) by username, policy documents are dropped so the index stays small
+def get_user_authorization_details(session, client=None):
+
+    if client is None:
+        client = get_boto_client(session, 'iam')
+
+    start = time.monotonic()
+    index = {}
+    pages = 0
+    for page in client.get_paginator('get_account_authorization_details').paginate(Filter=['User']):
+        pages += 1
+        for detail in page['UserDetailList']:
+            groups = tuple(detail.get('GroupList', ()))
+            policies = tuple(policy['PolicyName'] for policy in detail.get('AttachedManagedPolicies', ())) + tuple(policy['PolicyName'] for policy in detail.get('UserPolicyList', ()))
+            tags = {tag['Key']: tag['Value'] for tag in detail.get('Tags', ())}
+            index[detail['UserName']] = (groups, policies, tags)
+
+    print("Authorization details - {} users in {} pages, {:.3f}s".format(len(index), pages, time.monotonic() - start))
+    run_metrics.add_phase('Enrichment', time.monotonic() - start)
+    return index
+
+# Add the groups, policies and tags from the authorization details index to each user
+def enrich_users(users, index):
+    for user in users:
+        details = index.get(user.Username)
+        if details is not None:
+            user.Groups, user.Policies, user.Tags = details
+
+# Template fields for the password policy table and the password policy field each one shows
+password_policy_template_fields = {
+    'password-policy-min-pass-length' : 'MinimumPasswordLength',
+    'password-policy-require-symbols' : 'RequireSymbols',
+    'password-policy-require-numbers' : 'RequireNumbers',
+    'password-policy-require-uppercase' : 'RequireUppercaseCharacters',
+    'password-policy-require-lowercase' : 'RequireLowercaseCharacters',
+    'password-policy-users-change-passwords' : 'AllowUsersToChangePassword',
+    'password-policy-expire-passwords' : 'ExpirePasswords',
+    'password-policy-password-age' : 'MaxPasswordAge',
+    'password-policy-password-reuse' : 'PasswordReusePrevention',
+    'password-policy-hard-expire' : 'HardExpiry'
+}
+
+# Columns from the credentials report that are loaded into the models, along with the value to use if AWS ever drops the column
+# The order here is the order that the values are handed to the models in iter_report_users
+report_columns = (
+    ('user', None),
+    ('arn', None),
+    ('user_creation_time', None),
+    ('password_enabled', 'false'),
+    ('password_last_used', 'N/A'),
+    ('password_last_changed', 'N/A'),
+    ('password_next_rotation', 'N/A'),
+    ('mfa_active', 'false'),
+    ('access_key_1_active', 'false'),
+    ('access_key_1_last_rotated', 'N/A'),
+    ('access_key_1_last_used_date', 'N/A'),
+    ('access_key_1_last_used_region', 'N/A'),
+    ('access_key_1_last_used_service', 'N/A'),
+    ('access_key_2_active', 'false'),
+    ('access_key_2_last_rotated', 'N/A'),
+    ('access_key_2_last_used_date', 'N/A'),
+    ('access_key_2_last_used_region', 'N/A'),
+    ('access_key_2_last_used_service', 'N/A'),
+    ('cert_1_active', 'false'),
+    ('cert_1_last_rotated', 'N/A'),
+    ('cert_2_active', 'false'),
+    ('cert_2_last_rotated', 'N/A')
+)
+
+# Username AWS uses for the root account row in the credentials report
+root_account_username = '<root_account>'
+
+# Hand out the lines of the report one at a time (keeping the line endings for the csv reader) instead of splitting it into a list
+def iter_report_lines(content):
+    start = 0
+    content_length = len(content)
+    while start < content_length:
+        end = content.find('\n', start)
+        if end == -1:
+            end = content_length - 1
+        yield content[start:end + 1]
+        start = end + 1
+
+# Read the credentials file one row at a time and yield each user as it's loaded into the models
+# Columns are matched up by the names in the header row so a reordered or extended report still parses
+def iter_report_users(content):
+
+    # Raw report bytes are decoded as they are read rather than decoding a full copy of the report up front
+    if isinstance(content, bytes):
+        lines = io.TextIOWrapper(io.BytesIO(content), encoding='utf-8', newline='')
+    else:
+        lines = iter_report_lines(content)
+
+    reader = csv.reader(lines)
+
+    # The first row is the header, use it to find where each column is
+    header = next(reader, None)
+    if header is None:
+        return
+    column_index = {name: index for index, name in enumerate(header)}
+
+    positions = []
+    missing_values = []
+    for name, missing_value in report_columns:
+        if name in column_index:
+            positions.append(column_index[name])
+        elif missing_value is None:
+            raise ValueError("Credentials report is missing the required column " + name)
+        else:
+            # Missing columns are read from the end of the row where their default value gets added
+            positions.append(len(header) + len(missing_values))
+            missing_values.append(missing_value)
+    get_columns = operator.itemgetter(*positions)
+
+    for row_item in reader:
+        # Skip blank lines, such as a new line at the end of the report
+        if not row_item:
+            continue
+
+        # Skip the root account record because this should be explicitly handled by account owner
+        if row_item[positions[0]] == root_account_username:
+            continue
+
+        if missing_values:
+            row_item.extend(missing_values)
+
+        (username, arn, user_creation_time,
+         password_enabled, password_last_used, password_last_changed, password_next_rotation, mfa_active,
+         key1_active, key1_last_rotated, key1_last_used, key1_region, key1_service,
+         key2_active, key2_last_rotated, key2_last_used, key2_region, key2_service,
+         cert1_active, cert1_last_rotated, cert2_active, cert2_last_rotated) = get_columns(row_item)
+
+        # Create and populate current users password
+        current_user_password = Password(
+            ConvertToBool(password_enabled),
+            ConvertToDateTime(password_last_used),
+            ConvertToDateTime(password_last_changed),
+            ConvertToDateTime(password_next_rotation),
+            ConvertToBool(mfa_active))
+
+        # Create and populate current keys, region and service names repeat across users so they are interned to share one copy
+        current_user_keys = [
+            Key("Key1", ConvertToBool(key1_active), ConvertToDateTime(key1_last_rotated), ConvertToDateTime(key1_last_used), sys.intern(key1_region), sys.intern(key1_service)),
+            Key("Key2", ConvertToBool(key2_active), ConvertToDateTime(key2_last_rotated), ConvertToDateTime(key2_last_used), sys.intern(key2_region), sys.intern(key2_service))
+        ]
+
+        # Create and populate current certs
+        current_user_certs = [
+            Cert(ConvertToBool(cert1_active), ConvertToDateTime(cert1_last_rotated)),
+            Cert(ConvertToBool(cert2_active), ConvertToDateTime(cert2_last_rotated))
+        ]
+
+        # Create and populate user
+        row_hash = hashlib.blake2b('\x1f'.join(row_item).encode('utf-8'), digest_size=16).digest()
+        current_user = User(username, arn, ConvertToDateTime(user_creation_time), current_user_password, current_user_keys, current_user_certs, row_hash)
+
+        yield current_user
+
 # Parse the credentials file and load it into models
 def parse_report_to_models(content):
-    records = []
     # Collection of users parsed into models
-    users = []
+    return list(iter_report_users(content))
 
-    # Flag to detect and skip the first row (header)
-    header_row = True
-    # Skip the root account record because this should be explicitly handled by account owner
-    root_acount_record = True
-    for item in content.split("\n"):
-        # The first row is the header, skip it
-        if header_row:
-            header_row = False
-        elif root_acount_record:
-            root_acount_record = False
-        else:
-            records.append(item)
+# Users parsed from the last credentials report of each account, kept so a warm container doesn't parse the same report again
+parsed_report_users = {}
 
-    for record in records:
-        # split up each entry into it's column
-        row_item = record.split(",")
+# Get the credentials report and parse it into models, reusing the parsed users if the report hasn't changed since the last run
+def get_credentials_report_users(session, account_id=None, cache_session=None, client=None):
 
-        # Create and populate user
-        current_user = User()
-        current_user.Username = row_item[0]
-        current_user.ARN = row_item[1]
-        current_user.UserCreation = ConvertToDateTime(row_item[2])
-        
-        # Create and populate current users password
-        current_user_password = Password()
-        current_user_password.Enabled = row_item[3]
-        current_user_password.LastUsed = ConvertToDateTime(row_item[4])
-        current_user_password.LastChanged = ConvertToDateTime(row_item[5])
-        current_user_password.NextRotation = ConvertToDateTime(row_item[6])
-        current_user_password.ActiveMFA = row_item[7]
-        current_user.Password = current_user_password
-
-        # Create and populate current key 1
-        current_user_key1 = Key()
-        current_user_key1.KeyID = "Key1"
-        current_user_key1.Active = row_item[8]
-        current_user_key1.LastRotated = ConvertToDateTime(row_item[9])
-        current_user_key1.LastUsed = ConvertToDateTime(row_item[10])
-        current_user_key1.RegionLastUsed = row_item[11]
-        current_user_key1.ServiceLastUsed = row_item[12]
-        current_user.Keys.append(current_user_key1)
-
-        # Create and populate current key 2
-        current_user_key2 = Key()
-        current_user_key2.KeyID = "Key2"
-        current_user_key2.Active = row_item[13]
-        current_user_key2.LastRotated = ConvertToDateTime(row_item[14])
-        current_user_key2.LastUsed = ConvertToDateTime(row_item[15])
-        current_user_key2.RegionLastUsed = row_item[16]
-        current_user_key2.ServiceLastUsed = row_item[17]
-        current_user.Keys.append(current_user_key2)
-
-        # Create and populate current cert 1
-        current_cert1 = Cert()
-        current_cert1.Active = row_item[18]
-        current_cert1.LastRotated = ConvertToDateTime(row_item[19])
-        current_user.Certs.append(current_cert1)
-
-        # Create and populate current cert 1
-        current_cert2 = Cert()
-        current_cert2.Active = row_item[20]
-        current_cert2.LastRotated = ConvertToDateTime(row_item[21])
-        current_user.Certs.append(current_cert2)
-
-        # Add current user to Users list
-        users.append(current_user)
+    report = get_credentials_report(session, account_id, cache_session, client)
+    parsed_report = parsed_report_users.get(account_id)
+    if parsed_report is not None and parsed_report[0] == report.GeneratedTime:
+        return parsed_report[1]
+
+    start = time.monotonic()
+    users = run_profiled('parse', parse_report_to_models, report.Content)
+    run_metrics.add_phase('Parse', time.monotonic() - start)
+    parsed_report_users[account_id] = (report.GeneratedTime, users)
 
+    # Keep a copy of the parsed report for trend queries when history_path is set
+    if get_config().history_path is not None:
+        save_report_history(users, report.GeneratedTime, account_id)
     return users
 
+# Get the parsed credentials report and the password policies at the same time
+# The password policy (and the authorization details when enrich_users is set) are fetched on other threads while this thread downloads and parses the report
+def get_users_and_password_policies(session, account_id=None, cache_session=None):
+
+    # Clients are thread safe but sessions aren't, so the one IAM client is created here and shared by all the threads
+    client = get_boto_client(session, 'iam')
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        password_policies_future = executor.submit(get_account_password_policies, session, client)
+        authorization_details_future = None
+        if get_config().enrich_users:
+            authorization_details_future = executor.submit(get_user_authorization_details, session, client)
+        users = get_credentials_report_users(session, account_id, cache_session, client)
+        users_ready = time.monotonic()
+        password_policies = password_policies_future.result()
+        if authorization_details_future is not None:
+            enrich_users(users, authorization_details_future.result())
+
+    print("Report and password policy - {:.3f}s (report and parse {:.3f}s, waited {:.3f}s for the password policy)".format(time.monotonic() - start, users_ready - start, time.monotonic() - users_ready))
+    return users, password_policies
+
 # Calculate how many days have elapsesd since an event last occured
-def get_days_since_event(value):
+def get_days_since_event(value, today=None):
     if value is not None:
-        return (datetime.now(timezone.utc).date() - value.date()).days
+        # Allow callers evaluating many events to look up today's date only once
+        if today is None:
+            today = datetime.now(timezone.utc).date()
+        return (today - value.date()).days
+
+# Lookup of the HTML table cell to use for each rule status
+threshold_cells = {
+    'good' : threshold_cell_good,
+    'warning' : threshold_cell_warning,
+    'violation' : threshold_cell_violation
+}
+
+# Label and cell color for each status, used when the rows are sent as structured data
+threshold_labels = {
+    'good' : 'Good',
+    'warning' : 'Warning',
+    'violation' : 'Violation'
+}
+threshold_colors = {
+    'good' : '#4CA64C',
+    'warning' : '#ffff4c',
+    'violation' : '#ff3232'
+}
+
+# Recommendations for each rule, ordered as (good, warning, violation)
+mfa_recommendations = ("None", None, "Enable MFA ")
+inactive_user_recommendations = ("None", "Determine if user requires console access", "Remove console access for this account")
+password_age_recommendations = ("None", "Recommend user to change password soon", "Prompt user to change password immediately")
+inactive_key_recommendations = ("None", "Determine if key is needed", "Inactivate key")
+key_age_recommendations = ("None", "Rotate key soon or determine if needed", "Rotate or inactivate immediately")
+
+# Result of running a single rule against a user (and key if the rule applies to keys)
+# Days is the number of days since the event the rule checks (None for rules without a threshold)
+class Finding(object):
+    __slots__ = ('Status', 'User', 'Key', 'Recommendation', 'Days')
+
+    def __init__(self, status, user, recommendation, key=None, days=None):
+        self.Status = status
+        self.User = user
+        self.Key = key
+        self.Recommendation = recommendation
+        self.Days = days
+
+# Compare the number of days against the low and high threshold and return the finding for it
+def evaluate_threshold(days, low_threshold, high_threshold, recommendations, user, key=None):
+    if days < low_threshold:
+        return Finding('good', user, recommendations[0], key, days)
+    elif days >= low_threshold and days <= high_threshold:
+        return Finding('warning', user, recommendations[1], key, days)
+    else:
+        return Finding('violation', user, recommendations[2], key, days)
+
+# Low and high thresholds for each of the threshold rules
+# When a user is provided the thresholds include any overrides for the user's path and tags
+def get_rule_thresholds(user=None):
+    if user is not None:
+        overrides = get_threshold_overrides()
+        if overrides is not None:
+            return overrides.get_thresholds(user)
+
+    config = get_config()
+    return {
+        'inactive_users' : (config.inactive_user_low, config.inactive_user_high),
+        'password_rotation' : (config.password_age_low, config.password_age_high),
+        'inactive_keys' : (config.inactive_key_low, config.inactive_key_high),
+        'key_rotation' : (config.key_age_low, config.key_age_high)
+    }
+
+# Threshold overrides
+# -------------------- #
+# Users under an IAM path (ex. /service/) or with a tag (ex. break-glass) can have their own thresholds
+# threshold_overrides is a list of overrides, each one has a path or a tag (with an optional value) and the settings to change :
+# [{"path" : "/service/", "inactive_user_high" : 365}, {"tag" : "break-glass", "key_age_low" : 30, "key_age_high" : 60}]
+# Path overrides apply to every user under the path, deeper paths win over shorter ones, and tag overrides are applied last in list order
+# The path overrides are compiled into a trie so each user is looked up in one walk down their path
+
+# Setting name for each threshold, along with the rule and the position (low, high) it sets
+threshold_override_fields = {
+    'inactive_user_low' : ('inactive_users', 0),
+    'inactive_user_high' : ('inactive_users', 1),
+    'password_age_low' : ('password_rotation', 0),
+    'password_age_high' : ('password_rotation', 1),
+    'inactive_key_low' : ('inactive_keys', 0),
+    'inactive_key_high' : ('inactive_keys', 1),
+    'key_age_low' : ('key_rotation', 0),
+    'key_age_high' : ('key_rotation', 1)
+}
+
+# Node in the path trie, one for each path segment. Thresholds holds the settings set at exactly this path
+class PathTrieNode(object):
+    __slots__ = ('Children', 'Thresholds')
+
+    def __init__(self):
+        self.Children = {}
+        self.Thresholds = None
+
+# Apply the settings of an override to a copy of the thresholds
+def apply_threshold_override(thresholds, settings):
+    thresholds = dict(thresholds)
+    for name, value in settings.items():
+        rule, position = threshold_override_fields[name]
+        rule_threshold = list(thresholds[rule])
+        rule_threshold[position] = value
+        thresholds[rule] = tuple(rule_threshold)
+    return thresholds
+
+# Get the segments of a user's IAM path from their ARN, arn:aws:iam::123456789012:user/service/batch/name is ('service', 'batch')
+def get_path_segments(arn):
+    if arn is None:
+        return ()
+    return tuple(arn.split(':', 5)[-1].split('/')[1:-1])
+
+class ThresholdOverrides(object):
+    def __init__(self, overrides, default_thresholds):
+        self.Overrides = overrides
+        self.Root = PathTrieNode()
+        self.DefaultThresholds = default_thresholds
+        # Tag overrides indexed by tag key, as a list of (position in the overrides list, value, settings)
+        # The value is None for overrides that match any value of the tag
+        self.TagOverrides = {}
+        # Thresholds for each path that has been looked up, most users share a handful of paths
+        self.PathThresholds = {}
+
+        for position, override in enumerate(overrides):
+            settings = {name: value for name, value in override.items() if name not in ('path', 'tag', 'value')}
+            for name, value in settings.items():
+                if name not in threshold_override_fields:
+                    raise ValueError("Unknown setting " + name + " in threshold override " + json.dumps(override))
+                if not isinstance(value, int):
+                    raise ValueError("Setting " + name + " in threshold override " + json.dumps(override) + " has to be a whole number of days")
+
+            if 'path' in override:
+                node = self.Root
+                for segment in override['path'].strip('/').split('/'):
+                    if segment:
+                        node = node.Children.setdefault(segment, PathTrieNode())
+                node.Thresholds = dict(node.Thresholds or {}, **settings)
+            elif 'tag' in override:
+                self.TagOverrides.setdefault(override['tag'], []).append((position, override.get('value'), settings))
+            else:
+                raise ValueError("Threshold override " + json.dumps(override) + " needs a path or a tag")
+
+    # Walk down the trie along the path, applying the thresholds set at each level
+    def get_path_thresholds(self, segments):
+        thresholds = self.PathThresholds.get(segments)
+        if thresholds is None:
+            node = self.Root
+            thresholds = self.DefaultThresholds
+            if node.Thresholds is not None:
+                thresholds = apply_threshold_override(thresholds, node.Thresholds)
+            for segment in segments:
+                node = node.Children.get(segment)
+                if node is None:
+                    break
+                if node.Thresholds is not None:
+                    thresholds = apply_threshold_override(thresholds, node.Thresholds)
+            self.PathThresholds[segments] = thresholds
+        return thresholds
+
+    # Only the overrides for the user's own tag keys are checked, then applied in the order they're listed
+    def get_thresholds(self, user):
+        thresholds = self.get_path_thresholds(get_path_segments(user.ARN))
+        if user.Tags and self.TagOverrides:
+            matches = []
+            for tag, tag_value in user.Tags.items():
+                for position, value, settings in self.TagOverrides.get(tag, ()):
+                    if value is None or tag_value == value:
+                        matches.append((position, settings))
+            matches.sort(key=operator.itemgetter(0))
+            for _, settings in matches:
+                thresholds = apply_threshold_override(thresholds, settings)
+        return thresholds
+
+# Load the threshold overrides the first time they're needed, returns None when there aren't any
+@functools.lru_cache(maxsize=None)
+def get_threshold_overrides():
+    setting = get_config().threshold_overrides
+    if setting is None:
+        return None
+
+    # The setting is either the JSON list itself or the path of a file holding it (for lists too big for an environment variable)
+    if setting.lstrip().startswith('['):
+        overrides = json.loads(setting)
+    else:
+        with open(setting, 'r') as overrides_file:
+            overrides = json.load(overrides_file)
+
+    print("Threshold overrides - loaded {} override(s)".format(len(overrides)))
+    return ThresholdOverrides(overrides, get_rule_thresholds())
+
+# Rule statuses in the order of the codes returned by classify_days
+rule_statuses = ('good', 'warning', 'violation')
+
+# Value stored in the columnar date arrays when the report doesn't have a date for the event
+missing_epoch_day = -1
+
+# Number of days between the start of the unix epoch and the provided datetime
+def get_epoch_day(value):
+    if value is None:
+        return missing_epoch_day
+    return value.toordinal() - 719163
+
+# Column store of the dates the threshold rules need, each date is held as a count of days since the unix epoch
+# Every array lines up with the users list, the key arrays line up with the list of active keys
+class ReportColumns(object):
+    def __init__(self, users):
+        self.Users = users
+
+        # Each column is collected with one list comprehension and built into an array in one call, this is much faster than
+        # filling the arrays item by item or looping over the users once and appending to every list
+        passwords = [user.Password for user in users]
+        self.CreationDay = get_epoch_day_column([user.UserCreation for user in users])
+        self.PasswordEnabled = numpy.array([password.Enabled for password in passwords], dtype=bool)
+        self.ActiveMFA = numpy.array([password.ActiveMFA for password in passwords], dtype=bool)
+
+        # Only active keys are audited so they are the only ones loaded into the key columns
+        # The active keys are picked out with numpy so no tuple has to be created for each key
+        all_keys = [key for user in users for key in user.Keys]
+        all_key_user_index = numpy.repeat(numpy.arange(len(users), dtype=numpy.int64), [len(user.Keys) for user in users])
+        active_key_index = numpy.flatnonzero(numpy.array([key.Active for key in all_keys], dtype=bool))
+        self.KeyUserIndex = all_key_user_index[active_key_index]
+        self.Keys = [all_keys[index] for index in active_key_index.tolist()]
+        self.KeyUsers = [users[index] for index in self.KeyUserIndex.tolist()]
+
+        # Events that have never happened fall back to the date the user was created
+        self.PasswordLastUsedDay = fill_missing_days(get_epoch_day_column([password.LastUsed for password in passwords]), self.CreationDay)
+        self.PasswordLastChangedDay = fill_missing_days(get_epoch_day_column([password.LastChanged for password in passwords]), self.CreationDay)
+        key_creation_day = self.CreationDay[self.KeyUserIndex]
+        self.KeyLastUsedDay = fill_missing_days(get_epoch_day_column([key.LastUsed for key in self.Keys]), key_creation_day)
+        self.KeyLastRotatedDay = fill_missing_days(get_epoch_day_column([key.LastRotated for key in self.Keys]), key_creation_day)
+
+# Convert a list of datetimes (or None) into an array of epoch days, the conversion is written out inline to save a call per value
+def get_epoch_day_column(values):
+    return numpy.array([missing_epoch_day if value is None else value.toordinal() - 719163 for value in values], dtype=numpy.int32)
+
+# Replace any missing days with the matching value in the fallback array
+def fill_missing_days(days, fallback_days):
+    return numpy.where(days == missing_epoch_day, fallback_days, days)
+
+# Days since the event each threshold rule checks, for every user (password rules) or active key (key rules)
+def get_days_since_columns(columns, today):
+    today_day = get_epoch_day(today)
+    return {
+        'inactive_users' : today_day - columns.PasswordLastUsedDay.astype(numpy.int64),
+        'password_rotation' : today_day - columns.PasswordLastChangedDay.astype(numpy.int64),
+        'inactive_keys' : today_day - columns.KeyLastUsedDay.astype(numpy.int64),
+        'key_rotation' : today_day - columns.KeyLastRotatedDay.astype(numpy.int64)
+    }
+
+# Classify an array of days since an event against the thresholds, 0 = good, 1 = warning, 2 = violation
+def classify_days(days_since_event, low_threshold, high_threshold):
+    return numpy.where(days_since_event < low_threshold, 0, numpy.where(days_since_event <= high_threshold, 1, 2)).astype(numpy.int8)
+
+# Low and high thresholds of a rule for each row of its columns
+# Without threshold overrides every row has the same thresholds, so they're returned as numbers and numpy broadcasts them
+def get_threshold_columns(columns, rule, rule_thresholds):
+    overrides = get_threshold_overrides()
+    if overrides is None:
+        return rule_thresholds[rule]
+    users = columns.KeyUsers if rule in ('inactive_keys', 'key_rotation') else columns.Users
+    thresholds = [overrides.get_thresholds(user)[rule] for user in users]
+    return numpy.array([low for low, _ in thresholds], dtype=numpy.int32), numpy.array([high for _, high in thresholds], dtype=numpy.int32)
+
+# Run the threshold rules over every user and key at once and return an array of status codes for each rule, along with the days since each event
+def classify_report(columns, today):
+    days_since_columns = get_days_since_columns(columns, today)
+    rule_thresholds = get_rule_thresholds()
+    status_codes = {}
+    for rule, days_since_event in days_since_columns.items():
+        low_threshold, high_threshold = get_threshold_columns(columns, rule, rule_thresholds)
+        status_codes[rule] = classify_days(days_since_event, low_threshold, high_threshold)
+    return status_codes, days_since_columns
+
+# If user has display_actionable_only set to true then only write warning and violation records, returns None when every finding is written
+# A delta audit only keeps findings that changed, so all of them are written (resolved findings have a good status)
+def get_displayed_statuses(config):
+    if config.delta_audit or not config.display_actionable_only:
+        return None
+    return ('warning', 'violation')
+
+# HTML row rendering
+# -------------------- #
+# Each table row is written with one f-string and the rows are joined once at the end. Usernames are the only values that don't
+# come from this file, so a table's usernames are searched for HTML special characters as one string and only escaped when one turns up
+# SecurityAuditDigest-Benchmark.py times this against the old string concatenation : on 100k users the access levels table renders
+# about 1.2x faster. The rule tables take about as long as before : writing the rows is faster, but collecting and escaping the
+# displayed findings takes up the difference
+
+# Characters that have to be escaped before a value can be written into the HTML
+html_special_characters = re.compile('[&<>"\']')
+
+# Escape a value for the HTML report
+def escape_html(value):
+    if html_special_characters.search(value) is None:
+        return value
+    return html.escape(value)
+
+# Escape a list of values. IAM names can't contain any of the special characters so the search over the joined values is usually all that runs
+def escape_html_values(values):
+    if html_special_characters.search(''.join(values)) is None:
+        return values
+    return [escape_html(value) for value in values]
+
+# Text of a flag in the access levels table, indexed by the flag
+flag_labels = ('false', 'true')
+
+# Access levels table - Username, Console, Key 1, Key 2
+def render_access_level_rows(names, users):
+    return ''.join([f'''<tr align="center">
+                <td>{name}</td>
+                <td>{flag_labels[user.Password.Enabled]}</td>
+                <td>{flag_labels[user.Keys[0].Active]}</td>
+                <td>{flag_labels[user.Keys[1].Active]}</td>
+            </tr>
+            ''' for name, user in zip(names, users)])
+
+# MFA table - Status, Username, Recommendation
+def render_mfa_rows(statuses, user_cells, recommendations):
+    return ''.join([f'''<tr align="center">
+                    {threshold_cells[status]}
+                    <td>{user_cell}</td>
+                    <td>{recommendation}</td>
+                </tr>
+                ''' for status, user_cell, recommendation in zip(statuses, user_cells, recommendations)])
+
+# Inactive users and password rotation tables - Status, Username, Recommendation
+def render_user_rule_rows(statuses, user_cells, recommendations):
+    return ''.join([f'''<tr align="center">
+                {threshold_cells[status]}
+                <td>{user_cell}</td>
+                <td>{recommendation}</td>
+            </tr>''' for status, user_cell, recommendation in zip(statuses, user_cells, recommendations)])
+
+# Inactive keys and key rotation tables - Status, Username, Key Name, Recommendation
+def render_key_rule_rows(statuses, user_cells, keys, recommendations):
+    return ''.join([f'''<tr align="center">
+                    {threshold_cells[status]}
+                    <td>{user_cell}</td>
+                    <td>{key.KeyID}</td>
+                    <td>{recommendation}</td>
+                </tr>''' for status, user_cell, key, recommendation in zip(statuses, user_cells, keys, recommendations)])
+
+# Findings of one rule from evaluate_rules_columnar, kept as the array of status codes (and days since the event) for the users
+# (and keys). A Finding is only created for a row the first time it's used and then kept, so changes made to it (ex. by the
+# remediation) show up in the digest. Reports that only show warnings and violations never create the good findings
+# Iterating over it creates every finding, select_findings and count_finding_statuses work from the arrays instead
+class ColumnarFindings(object):
+    def __init__(self, status_codes, days_since_event, recommendations, users, keys=None):
+        self.StatusCodes = status_codes
+        self.Days = days_since_event
+        self.Recommendations = recommendations
+        self.Users = users
+        self.Keys = keys
+        # Findings created so far, by row
+        self.Findings = {}
+
+    def __len__(self):
+        return len(self.Users)
+
+    def __iter__(self):
+        return iter(self.get_findings())
+
+    # Rows with one of the statuses (every row when statuses is None) as an array of row numbers
+    def get_indexes(self, statuses=None):
+        if statuses is None:
+            return numpy.arange(len(self.Users))
+        return numpy.flatnonzero(numpy.isin(self.StatusCodes, [rule_statuses.index(status) for status in statuses]))
+
+    # Findings for the rows with one of the statuses, in row order
+    def get_findings(self, statuses=None):
+        indexes = self.get_indexes(statuses)
+
+        # The values of the rows are pulled out of the arrays in one go, indexing numpy arrays one item at a time is slow
+        status_codes = self.StatusCodes[indexes].tolist()
+        days = self.Days[indexes].tolist() if self.Days is not None else [None] * len(status_codes)
+
+        findings = self.Findings
+        users = self.Users
+        keys = self.Keys
+        recommendations = self.Recommendations
+        selected = []
+        for index, code, days_since_event in zip(indexes.tolist(), status_codes, days):
+            finding = findings.get(index)
+            if finding is None:
+                finding = findings[index] = Finding(rule_statuses[code], users[index], recommendations[code], None if keys is None else keys[index], days_since_event)
+            selected.append(finding)
+        return selected
+
+    # Status, user, key and recommendation columns of the rows with one of the statuses, without creating findings for them
+    # Rows that already have a finding use it, its recommendation may have been changed
+    def get_values(self, statuses=None):
+        indexes = self.get_indexes(statuses)
+        status_codes = self.StatusCodes[indexes].tolist()
+        indexes = indexes.tolist()
+        users = self.Users
+        keys = self.Keys
+        recommendations = self.Recommendations
+        values = (
+            [rule_statuses[code] for code in status_codes],
+            [users[index] for index in indexes],
+            [keys[index] for index in indexes] if keys is not None else [None] * len(indexes),
+            [recommendations[code] for code in status_codes]
+        )
+
+        if self.Findings:
+            for position, index in enumerate(indexes):
+                finding = self.Findings.get(index)
+                if finding is not None:
+                    values[0][position] = finding.Status
+                    values[3][position] = finding.Recommendation
+        return values
+
+    # Number of findings with each status
+    def count_statuses(self):
+        counts = numpy.bincount(self.StatusCodes, minlength=len(rule_statuses)).tolist()
+        return {status : count for status, count in zip(rule_statuses, counts) if count}
+
+# Findings of a rule with one of the statuses, without creating the other findings when the rule was evaluated with numpy
+def select_findings(findings, statuses):
+    if isinstance(findings, ColumnarFindings):
+        return findings.get_findings(statuses)
+    return [finding for finding in findings if finding.Status in statuses]
+
+# Number of findings of a rule with each status
+def count_finding_statuses(findings):
+    if isinstance(findings, ColumnarFindings):
+        return findings.count_statuses()
+    counts = {}
+    for finding in findings:
+        counts[finding.Status] = counts.get(finding.Status, 0) + 1
+    return counts
 
 class Rules(object):
     
     def __init__(self, users):
         self.Users = users
+        # Findings for each rule, populated once by evaluate_rules and shared by all of the row generators
+        self.Results = None
+        # Flag to show the account ID next to each username, used when the digest covers more than one account
+        self.ShowAccount = False
+
+    # Name to show for a user in the report tables
+    def get_display_name(self, user):
+        if self.ShowAccount and user.ARN is not None:
+            return user.ARN.split(':')[4] + '/' + user.Username
+        return user.Username
 
     # Get today's date and format it for display on the report
     def get_today_date_formatted(self):
+        import calendar
         current_date = datetime.today()
         output_date = calendar.month_name[current_date.month] + " " +  str(current_date.day) + " " +  str(current_date.year)
         return output_date
 
-    # Generate formatted html rows to display in the access_levels table
-    def generate_access_level_rows(self):
-
-        temp_list = []
-
-        # Loop through all users and collect the values for each required field
-        for user in self.Users:
-            # Populate formatted string with user values
-            temp = '''<tr align="center">
-                <td>''' + user.Username + '''</td>
-                <td>'''+ str(user.Password.Enabled) +'''</td>
-                <td>''' + str(user.Keys[0].Active) + '''</td>
-                <td>''' + str(user.Keys[1].Active) + '''</td>
-            </tr>
-            '''
-            # Add row to list 
-            temp_list.append(temp)
-        # Concat all rows into one string to drop into the template 
-        return ''.join(temp_list)
+    # Run every rule against each user and key in a single pass over the users and sort the findings into a bucket per rule
+    def evaluate_rules(self):
 
-    # Rule to check if users have MFA enabled on their accounts
-    def generate_mfa_enabled_rows(self):
-        
-        temp_list =  []
+        # Rules only need to be evaluated once, every row generator reads from the same buckets
+        if self.Results is not None:
+            return self.Results
 
-        # Check if flag is set to run this check, if not then table will be empty
-        if check_mfa == 'True':
-            
-            # Loop through each user and run their account agaisnt the thresholds. Generate a HTML row as output
-            for user in self.Users:
-                
-                # Default Values
-                status = 'good'
-                threshold_cell = threshold_cell_good
-                recommendation = "None"
-
-                # Check if the user has MFA active on their account
-                if user.Password.ActiveMFA == 'false':
-                    status = 'violation'
-                    threshold_cell = threshold_cell_violation
-                    recommendation = "Enable MFA "
-                
-                # HTML Row Template - Populate with the value from the rule check
-                temp = '''<tr align="center">
-                    '''+ threshold_cell +'''
-                    <td>'''+ user.Username +'''</td>
-                    <td>'''+ recommendation +'''</td>
-                </tr>
-                '''
+        config = get_config()
 
-                # If user has display_actionable_only set to true then only write warning and violation records
-                if display_actionable_only == 'True' and status != 'good' or display_actionable_only == 'False' :
-                    # Add row to list 
-                    temp_list.append(temp)
+        # Use the numpy version of the rules if it's been turned on and numpy is available
+        if config.columnar_evaluation:
+            if import_numpy() is not None:
+                return self.evaluate_rules_columnar()
+            print("columnar_evaluation is set but numpy isn't installed, evaluating rules one user at a time")
 
-        # Concat all rows into one string to drop into the template 
-        return ''.join(temp_list)
+        mfa_findings = []
+        inactive_user_findings = []
+        password_age_findings = []
+        inactive_key_findings = []
+        key_age_findings = []
 
-    # Rule to check for inactive users
-    def generate_inactive_users_rows(self):
-        
-        temp_list =  []
+        # Only look up today's date and the settings once for the whole run instead of once per check
+        today = datetime.now(timezone.utc).date()
+        check_mfa = config.check_mfa
+        inactive_user_low, inactive_user_high = config.inactive_user_low, config.inactive_user_high
+        password_age_low, password_age_high = config.password_age_low, config.password_age_high
+        inactive_key_low, inactive_key_high = config.inactive_key_low, config.inactive_key_high
+        key_age_low, key_age_high = config.key_age_low, config.key_age_high
+        overrides = get_threshold_overrides()
 
-        # Loop through each user and run their account agaisnt the thresholds. Generate a HTML row as output
         for user in self.Users:
-            
-            # Default Values
-            status='good'
-            threshold_cell = None
-            recommendation = None
 
-            # If user doesn't have console access, don't check password rules for them
-            if user.Password.Enabled == 'false':
-                continue
+            # Users under an overridden path or with an overridden tag have their own thresholds
+            if overrides is not None:
+                thresholds = overrides.get_thresholds(user)
+                inactive_user_low, inactive_user_high = thresholds['inactive_users']
+                password_age_low, password_age_high = thresholds['password_rotation']
+                inactive_key_low, inactive_key_high = thresholds['inactive_keys']
+                key_age_low, key_age_high = thresholds['key_rotation']
             
-            days_since_last_used = 0
-            # Check when / if the user has ever used their password
-            if user.Password.LastUsed == None:
-                days_since_last_used = get_days_since_event(user.UserCreation)
-            else:
-                days_since_last_used = get_days_since_event(user.Password.LastUsed)
-
-            # Run audit for inactive users
-            if days_since_last_used < inactive_user_low:
-                status='good'
-                threshold_cell = threshold_cell_good
-                recommendation = "None"
-            elif days_since_last_used >=  inactive_user_low and days_since_last_used <= inactive_user_high:
-                status='warning'
-                threshold_cell = threshold_cell_warning
-                recommendation = "Determine if user requires console access"
-            else:
-                status='violation'
-                threshold_cell = threshold_cell_violation
-                recommendation = "Remove console access for this account"
+            # Days since the user was created, used whenever an event has never happened
+            days_since_creation = get_days_since_event(user.UserCreation, today)
 
-            # Row template
-            temp = '''<tr align="center">
-                '''+ threshold_cell +'''
-                <td>'''+ user.Username +'''</td>
-                <td>'''+ recommendation +'''</td>
-            </tr>'''
+            # Check if the user has MFA active on their account
+            if check_mfa:
+                if not user.Password.ActiveMFA:
+                    mfa_findings.append(Finding('violation', user, mfa_recommendations[2]))
+                else:
+                    mfa_findings.append(Finding('good', user, mfa_recommendations[0]))
 
-            # If user has display_actionable_only set to true then only write warning and violation records
-            if display_actionable_only == 'True' and status != 'good' or display_actionable_only == 'False' :
-                # Add row to list 
-                temp_list.append(temp)
+            # If user doesn't have console access, don't check password rules for them
+            if user.Password.Enabled:
+                
+                # Check when / if the user has ever used their password
+                if user.Password.LastUsed == None:
+                    days_since_last_used = days_since_creation
+                else:
+                    days_since_last_used = get_days_since_event(user.Password.LastUsed, today)
+                inactive_user_findings.append(evaluate_threshold(days_since_last_used, inactive_user_low, inactive_user_high, inactive_user_recommendations, user))
 
-        # Concat all rows into one string to drop into the template 
-        return ''.join(temp_list)
+                # Check when / if the user has ever changed their password
+                if user.Password.LastChanged == None:
+                    days_since_last_changed = days_since_creation
+                else:
+                    days_since_last_changed = get_days_since_event(user.Password.LastChanged, today)
+                password_age_findings.append(evaluate_threshold(days_since_last_changed, password_age_low, password_age_high, password_age_recommendations, user))
 
-    # Generate rows to populate the password rotation table
-    def generate_password_rotation_rows(self):
-        
-        temp_list =  []
+            # Loop through each key on a users account
+            for key in user.Keys:
+                
+                # If key isn't active then don't run an audit on it
+                if not key.Active:
+                    continue
 
-        # Loop through each user and run their account agaisnt the thresholds. Generate a HTML row as output
-        for user in self.Users:
-            
-            # Default Values
-            status='good'
-            threshold_cell = None
-            recommendation = None
-            days_since_last_changed = 0
+                # Check when / if the key has ever been used
+                if key.LastUsed == None:
+                    days_since_last_used = days_since_creation
+                else:
+                    days_since_last_used = get_days_since_event(key.LastUsed, today)
+                inactive_key_findings.append(evaluate_threshold(days_since_last_used, inactive_key_low, inactive_key_high, inactive_key_recommendations, user, key))
 
-            # If user doesn't have console access, don't check password rules for them
-            if user.Password.Enabled == 'false':
-                continue
+                # Check when / if the key has ever been rotated
+                if key.LastRotated == None:
+                    days_since_last_rotated = days_since_creation
+                else:
+                    days_since_last_rotated = get_days_since_event(key.LastRotated, today)
+                key_age_findings.append(evaluate_threshold(days_since_last_rotated, key_age_low, key_age_high, key_age_recommendations, user, key))
+
+        self.Results = {
+            'mfa' : mfa_findings,
+            'inactive_users' : inactive_user_findings,
+            'password_rotation' : password_age_findings,
+            'inactive_keys' : inactive_key_findings,
+            'key_rotation' : key_age_findings
+        }
+        return self.Results
+
+    # Same as evaluate_rules, but loads the dates into numpy arrays and runs the threshold checks as array comparisons
+    # The results are kept as arrays (see ColumnarFindings), findings are only created for the rows that are used
+    def evaluate_rules_columnar(self):
+
+        columns = ReportColumns(self.Users)
+        status_codes, days_since_columns = classify_report(columns, datetime.now(timezone.utc).date())
+
+        # MFA is a simple flag check so there is no threshold to classify, users without MFA are violations
+        mfa_findings = []
+        if get_config().check_mfa:
+            mfa_findings = ColumnarFindings(numpy.where(columns.ActiveMFA, 0, 2).astype(numpy.int8), None, mfa_recommendations, columns.Users)
+
+        # Password rules are only run against users with console access
+        password_enabled = columns.PasswordEnabled
+        password_users = [columns.Users[index] for index in numpy.flatnonzero(password_enabled).tolist()]
+
+        self.Results = {
+            'mfa' : mfa_findings,
+            'inactive_users' : ColumnarFindings(status_codes['inactive_users'][password_enabled], days_since_columns['inactive_users'][password_enabled], inactive_user_recommendations, password_users),
+            'password_rotation' : ColumnarFindings(status_codes['password_rotation'][password_enabled], days_since_columns['password_rotation'][password_enabled], password_age_recommendations, password_users),
+            'inactive_keys' : ColumnarFindings(status_codes['inactive_keys'], days_since_columns['inactive_keys'], inactive_key_recommendations, columns.KeyUsers, columns.Keys),
+            'key_rotation' : ColumnarFindings(status_codes['key_rotation'], days_since_columns['key_rotation'], key_age_recommendations, columns.KeyUsers, columns.Keys)
+        }
+        return self.Results
 
-            # Check when / if the user has ever used their password
-            if user.Password.LastChanged == None:
-                days_since_last_changed = get_days_since_event(user.UserCreation)
-            else:
-                days_since_last_changed = get_days_since_event(user.Password.LastChanged)
-
-            # Run audit for inactive users
-            if days_since_last_changed < password_age_low:
-                status='good'
-                threshold_cell = threshold_cell_good
-                recommendation = "None"
-            elif days_since_last_changed >=  password_age_low and days_since_last_changed <= password_age_high:
-                status='warning'
-                threshold_cell = threshold_cell_warning
-                recommendation = "Recommend user to change password soon"
-            else:
-                status='violation'
-                threshold_cell = threshold_cell_violation
-                recommendation = "Prompt user to change password immediately"
+    # Generate formatted html rows to display in the access_levels table
+    def generate_access_level_rows(self):
+        return render_access_level_rows(self.get_display_names(self.Users), self.Users)
+
+    # Escaped display names of the users, in the same order
+    def get_display_names(self, users):
+        if self.ShowAccount:
+            return escape_html_values([self.get_display_name(user) for user in users])
+        return escape_html_values([user.Username for user in users])
+
+    # Username cell of a finding, users that have been enriched also show their groups, policies and tags to help triage the finding
+    def get_user_cell(self, user):
+        name = escape_html(self.get_display_name(user))
+        if user.Groups is None:
+            return name
+        details = []
+        if user.Groups:
+            details.append('Groups: ' + ', '.join(escape_html(group) for group in user.Groups))
+        if user.Policies:
+            details.append('Policies: ' + ', '.join(escape_html(policy) for policy in user.Policies))
+        if user.Tags:
+            details.append('Tags: ' + ', '.join(escape_html(key + '=' + value) for key, value in user.Tags.items()))
+        if not details:
+            return name
+        return name + '<br/><small>' + ' | '.join(details) + '</small>'
+
+    # Username cells of the users, in the same order. Only enriched users need more than their escaped name
+    def get_user_cells(self, users):
+        if not get_config().enrich_users:
+            return self.get_display_names(users)
+        get_user_cell = self.get_user_cell
+        return [name if user.Groups is None else get_user_cell(user) for name, user in zip(self.get_display_names(users), users)]
+
+    # Get the status, user, key and recommendation columns of the findings of the rule that should be displayed
+    # Results from evaluate_rules_columnar are read from their arrays without creating a finding for every row
+    # The values are returned as separate lists and zipped back together by the callers, a tuple per row would be more garbage to collect
+    def get_displayed_values(self, rule):
+        findings = self.evaluate_rules()[rule]
+        statuses = get_displayed_statuses(get_config())
+
+        if isinstance(findings, ColumnarFindings):
+            return findings.get_values(statuses)
+        if statuses is not None:
+            findings = select_findings(findings, statuses)
+        return ([finding.Status for finding in findings], [finding.User for finding in findings], [finding.Key for finding in findings], [finding.Recommendation for finding in findings])
+
+    # Get the status, user cell, key and recommendation columns of a rule table, only findings that should be displayed are included
+    # Recommendations and key IDs are fixed strings from this file so only the username has to be escaped
+    def get_finding_columns(self, rule):
+        statuses, users, keys, recommendations = self.get_displayed_values(rule)
+        return statuses, self.get_user_cells(users), keys, recommendations
+
+    # Structured versions of the tables for the {{#each}} email template, each row is a small dict instead of a block of HTML
+    def generate_access_level_data(self):
+        return [{'user' : name, 'console' : format_flag(user.Password.Enabled), 'key1' : format_flag(user.Keys[0].Active), 'key2' : format_flag(user.Keys[1].Active)} for name, user in zip(self.get_display_names(self.Users), self.Users)]
+
+    def generate_finding_data(self, rule, include_key):
+        statuses, user_cells, keys, recommendations = self.get_finding_columns(rule)
+        if include_key:
+            return [{'status' : threshold_labels[status], 'color' : threshold_colors[status], 'user' : user_cell, 'key' : key.KeyID, 'recommendation' : recommendation} for status, user_cell, key, recommendation in zip(statuses, user_cells, keys, recommendations)]
+        return [{'status' : threshold_labels[status], 'color' : threshold_colors[status], 'user' : user_cell, 'recommendation' : recommendation} for status, user_cell, recommendation in zip(statuses, user_cells, recommendations)]
 
-            # Row template
-            temp = '''<tr align="center">
-                '''+ threshold_cell +'''
-                <td>'''+ user.Username +'''</td>
-                <td>'''+ recommendation +'''</td>
-            </tr>'''
+    # Rule to check if users have MFA enabled on their accounts
+    # Table will be empty if the check_mfa flag isn't set since the rule won't have any findings
+    def generate_mfa_enabled_rows(self):
+        statuses, user_cells, _, recommendations = self.get_finding_columns('mfa')
+        return render_mfa_rows(statuses, user_cells, recommendations)
 
-            # If user has display_actionable_only set to true then only write warning and violation records
-            if display_actionable_only == 'True' and status != 'good' or display_actionable_only == 'False' :
-                # Add row to list 
-                temp_list.append(temp)
+    # Rule to check for inactive users
+    def generate_inactive_users_rows(self):
+        statuses, user_cells, _, recommendations = self.get_finding_columns('inactive_users')
+        return render_user_rule_rows(statuses, user_cells, recommendations)
 
-        # Concat all rows into one string to drop into the template 
-        return ''.join(temp_list)
+    # Generate rows to populate the password rotation table
+    def generate_password_rotation_rows(self):
+        statuses, user_cells, _, recommendations = self.get_finding_columns('password_rotation')
+        return render_user_rule_rows(statuses, user_cells, recommendations)
 
     # Rule to check for inactive keys on user accounts 
     def generate_inactive_keys_rows(self):
-        
-        temp_list =  []
+        return render_key_rule_rows(*self.get_finding_columns('inactive_keys'))
 
-        for user in self.Users:
-            
-            # Default Values
-            status='good'
-            threshold_cell = None
-            recommendation = None
+    # Rule to check when a users keys were last rotated
+    def generate_key_rotation_rows(self):
+        return render_key_rule_rows(*self.get_finding_columns('key_rotation'))
 
-            # Loop through each key on a users account
-            for key in user.Keys:
-                
-                # If key isn't active then don't run an audit on it
-                if key.Active == 'false':
+# Report history
+# -------------------- #
+# When history_path is set each parsed credentials report is saved as a snapshot of numpy arrays, one .npy file per column
+# Snapshots are partitioned by the date IAM generated the report : <history_path>/<account>/date=YYYY-MM-DD/<HHMMSS>/
+# The files are read back memory mapped, so queries over months of snapshots only read the columns they use and never parse CSV again
+# Dates are stored as days since the unix epoch (missing_epoch_day when the report doesn't have one), every user has two keys
+
+# Version of the snapshot layout, written to each snapshot's metadata
+history_version = 1
+
+# Name of the partition used for the account running the Lambda
+history_default_account = 'default'
+
+# Build the columns of a snapshot from the parsed users
+def get_history_columns(users):
+    return {
+        'Username' : numpy.array([user.Username.encode('utf-8') for user in users], dtype=bytes),
+        'Path' : numpy.array(['/'.join(('',) + get_path_segments(user.ARN) + ('',)).encode('utf-8') for user in users], dtype=bytes),
+        'CreationDay' : numpy.array([get_epoch_day(user.UserCreation) for user in users], dtype=numpy.int32),
+        'PasswordEnabled' : numpy.array([user.Password.Enabled for user in users], dtype=bool),
+        'ActiveMFA' : numpy.array([user.Password.ActiveMFA for user in users], dtype=bool),
+        'PasswordLastUsedDay' : numpy.array([get_epoch_day(user.Password.LastUsed) for user in users], dtype=numpy.int32),
+        'PasswordLastChangedDay' : numpy.array([get_epoch_day(user.Password.LastChanged) for user in users], dtype=numpy.int32),
+        'KeyActive' : numpy.array([[key.Active for key in user.Keys] for user in users], dtype=bool).reshape(len(users), 2),
+        'KeyLastRotatedDay' : numpy.array([[get_epoch_day(key.LastRotated) for key in user.Keys] for user in users], dtype=numpy.int32).reshape(len(users), 2),
+        'KeyLastUsedDay' : numpy.array([[get_epoch_day(key.LastUsed) for key in user.Keys] for user in users], dtype=numpy.int32).reshape(len(users), 2)
+    }
+
+# Directory of the snapshot for a report generated at the time
+def get_snapshot_directory(history_path, account_id, generated_time):
+    generated_time = generated_time.astimezone(timezone.utc)
+    return os.path.join(history_path, account_id or history_default_account, 'date=' + generated_time.strftime('%Y-%m-%d'), generated_time.strftime('%H%M%S'))
+
+# Write a snapshot of the users, returns False if there's already a snapshot of this report
+# The columns are written to a temporary directory that's renamed into place, so a reader never sees a partly written snapshot
+def write_report_snapshot(history_path, users, generated_time, account_id=None):
+    directory = get_snapshot_directory(history_path, account_id, generated_time)
+    if os.path.isdir(directory):
+        return False
+
+    temporary_directory = directory + '.tmp-' + str(os.getpid()) + '-' + str(threading.get_ident())
+    os.makedirs(temporary_directory)
+    for name, column in get_history_columns(users).items():
+        numpy.save(os.path.join(temporary_directory, name + '.npy'), column)
+    with open(os.path.join(temporary_directory, 'snapshot.json'), 'w') as metadata_file:
+        json.dump({'Version' : history_version, 'GeneratedTime' : generated_time.isoformat(), 'Users' : len(users)}, metadata_file)
+
+    try:
+        os.rename(temporary_directory, directory)
+    except OSError:
+        # Another run saved the same report first
+        import shutil
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+        return False
+    return True
+
+# Save the parsed report to the history, a failure is logged and doesn't stop the digest
+def save_report_history(users, generated_time, account_id=None):
+    if import_numpy() is None:
+        print("history_path is set but numpy isn't installed, the report isn't saved to the history")
+        return
+
+    start = time.monotonic()
+    try:
+        saved = write_report_snapshot(get_config().history_path, users, generated_time, account_id)
+    except OSError as error:
+        print("Report history - failed to save the report : {!r}".format(error))
+        return
+    run_metrics.add_phase('History', time.monotonic() - start)
+    if saved:
+        print("Report history - saved {} users in {:.3f}s".format(len(users), time.monotonic() - start))
+
+# Snapshot of one parsed report, the columns are memory mapped the first time they're used
+class ReportSnapshot(object):
+    def __init__(self, directory, generated_time):
+        self.Directory = directory
+        self.GeneratedTime = generated_time
+        self.Day = get_epoch_day(generated_time)
+        self.Columns = {}
+
+    def column(self, name):
+        column = self.Columns.get(name)
+        if column is None:
+            column = self.Columns[name] = numpy.load(os.path.join(self.Directory, name + '.npy'), mmap_mode='r')
+        return column
+
+    # Days since each active key was rotated, keys that were never rotated count from when the user was created
+    def get_active_key_ages(self):
+        creation_day = self.column('CreationDay')[:, numpy.newaxis]
+        last_rotated_day = fill_missing_days(self.column('KeyLastRotatedDay'), creation_day)
+        return self.Day - last_rotated_day[self.column('KeyActive')].astype(numpy.int64)
+
+# Reader over the snapshots saved for one account
+class ReportHistory(object):
+    def __init__(self, history_path, account_id=None):
+        if import_numpy() is None:
+            raise RuntimeError("Reading the report history requires numpy")
+        self.Directory = os.path.join(history_path, account_id or history_default_account)
+
+    # Snapshots of reports generated between start and end (dates or datetimes, both included), oldest first
+    # Partitions outside the range are skipped by their name without opening any of their files
+    def get_snapshots(self, start=None, end=None):
+        start_date = None if start is None else start.strftime('%Y-%m-%d')
+        end_date = None if end is None else end.strftime('%Y-%m-%d')
+        snapshots = []
+        try:
+            partitions = sorted(os.listdir(self.Directory))
+        except FileNotFoundError:
+            return snapshots
+
+        for partition in partitions:
+            if not partition.startswith('date='):
+                continue
+            date = partition[len('date='):]
+            if (start_date is not None and date < start_date) or (end_date is not None and date > end_date):
+                continue
+            partition_directory = os.path.join(self.Directory, partition)
+            for name in sorted(os.listdir(partition_directory)):
+                # Skip snapshots that are still being written
+                if '.tmp-' in name:
                     continue
-                
-                days_since_last_used = 0
-                # Check when / if the user has ever used their password
-                if key.LastUsed == None:
-                    days_since_last_used = get_days_since_event(user.UserCreation)
-                else:
-                    days_since_last_used = get_days_since_event(key.LastUsed)
-
-                # Run audit for inactive users
-                if days_since_last_used < inactive_key_low:
-                    status='good'
-                    threshold_cell = threshold_cell_good
-                    recommendation = "None"
-                elif days_since_last_used >=  inactive_key_low and days_since_last_used <= inactive_key_high:
-                    status='warning'
-                    threshold_cell = threshold_cell_warning
-                    recommendation = "Determine if key is needed"
-                else:
-                    status='violation'
-                    threshold_cell = threshold_cell_violation
-                    recommendation = "Inactivate key"
-
-                # Row template
-                temp = '''<tr align="center">
-                    '''+ threshold_cell +'''
-                    <td>'''+ user.Username +'''</td>
-                    <td>'''+ key.KeyID +'''</td>
-                    <td>'''+ recommendation +'''</td>
-                </tr>'''
-
-                # If user has display_actionable_only set to true then only write warning and violation records
-                if display_actionable_only == 'True' and status != 'good' or display_actionable_only == 'False' :
-                    # Add row to list 
-                    temp_list.append(temp)
-
-        # Concat all rows into one string to drop into the template 
-        return ''.join(temp_list)
+                directory = os.path.join(partition_directory, name)
+                with open(os.path.join(directory, 'snapshot.json'), 'r') as metadata_file:
+                    metadata = json.load(metadata_file)
+                snapshots.append(ReportSnapshot(directory, datetime.fromisoformat(metadata['GeneratedTime'])))
+        return snapshots
+
+    # Last snapshot of each week (weeks start on Monday) between start and end, as (first day of the week, snapshot)
+    def get_weekly_snapshots(self, start=None, end=None):
+        weeks = {}
+        for snapshot in self.get_snapshots(start, end):
+            generated_date = snapshot.GeneratedTime.astimezone(timezone.utc).date()
+            weeks[generated_date - timedelta(days=generated_date.weekday())] = snapshot
+        return sorted(weeks.items(), key=operator.itemgetter(0))
+
+# Count the active keys older than the number of days in the last snapshot of each week, ex. keys older than 90 days over the last year
+# Returns a list of (first day of the week, number of keys)
+def count_old_keys_by_week(history, days, start=None, end=None):
+    return [(week, int(numpy.count_nonzero(snapshot.get_active_key_ages() > days))) for week, snapshot in history.get_weekly_snapshots(start, end)]
+
+# Delta audit
+# -------------------- #
+# Keeps the status of every finding from the last run in a SQLite database so the digest only has to show what changed
+# A user is only run through the rules again when their row in the report changed, the rule settings changed,
+# or enough days have passed that one of their findings could have moved to a new status
+
+# Order of the statuses from least to most severe, used to tell if a finding escalated
+status_severity = {'good' : 0, 'warning' : 1, 'violation' : 2}
+
+# Rules that are checked against keys instead of the user
+key_rules = ('inactive_keys', 'key_rotation')
+
+# Epoch day stored for users that have no findings that can change with time
+never_changes_day = 2 ** 31 - 1
+
+# SQLite database holding each user's row hash and the last status of each of their findings
+class StateStore(object):
+    def __init__(self, path):
+        import sqlite3
+        self.Connection = sqlite3.connect(path)
+        self.Connection.executescript('''
+            CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, row_hash BLOB, next_change_day INTEGER);
+            CREATE TABLE IF NOT EXISTS findings (username TEXT, rule TEXT, key_id TEXT, status TEXT, PRIMARY KEY (username, rule, key_id));
+        ''')
+
+    def get_setting(self, name):
+        row = self.Connection.execute('SELECT value FROM settings WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    # Returns a dictionary of username to (row hash, next change day)
+    def load_users(self):
+        return {username: (row_hash, next_change_day) for username, row_hash, next_change_day in self.Connection.execute('SELECT username, row_hash, next_change_day FROM users')}
+
+    # Returns a dictionary of username to a dictionary of (rule, key id) to status
+    def load_findings(self):
+        findings = {}
+        for username, rule, key_id, status in self.Connection.execute('SELECT username, rule, key_id, status FROM findings'):
+            findings.setdefault(username, {})[(rule, key_id)] = status
+        return findings
+
+    # Replace the state of the users that were evaluated, and remove users that are no longer in the report
+    def save(self, settings_fingerprint, user_states, findings, removed_usernames):
+        with self.Connection:
+            usernames = [(username,) for username in removed_usernames] + [(state[0],) for state in user_states]
+            self.Connection.executemany('DELETE FROM findings WHERE username = ?', usernames)
+            self.Connection.executemany('DELETE FROM users WHERE username = ?', [(username,) for username in removed_usernames])
+            self.Connection.executemany('INSERT OR REPLACE INTO users (username, row_hash, next_change_day) VALUES (?, ?, ?)', user_states)
+            self.Connection.executemany('INSERT INTO findings (username, rule, key_id, status) VALUES (?, ?, ?, ?)', findings)
+            self.Connection.execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)', ('fingerprint', settings_fingerprint))
+
+    def close(self):
+        self.Connection.close()
+
+# Fingerprint of the settings that affect rule results, if any of them change every user is evaluated again
+def get_settings_fingerprint():
+    settings = [get_config().check_mfa, get_rule_thresholds()]
+    overrides = get_threshold_overrides()
+    if overrides is not None:
+        settings.append(overrides.Overrides)
+    return json.dumps(settings, sort_keys=True)
+
+# Number of days until a finding could move to a different status if the user's row doesn't change
+def get_days_until_change(rule, finding):
+    if finding.Days is None or finding.Status == 'violation':
+        return None
+    low_threshold, high_threshold = get_rule_thresholds(finding.User)[rule]
+    if finding.Status == 'good':
+        return low_threshold - finding.Days
+    return high_threshold + 1 - finding.Days
+
+# Compare a finding against its status from the last run and return what changed (new, escalated, improved or resolved)
+# Returns None when the finding hasn't changed in a way that needs to be reported
+def get_finding_change(previous_status, status):
+    if previous_status is None or previous_status == 'good':
+        if status == 'good':
+            return None
+        return 'new'
+    if status == 'good':
+        return 'resolved'
+    if status_severity[status] > status_severity[previous_status]:
+        return 'escalated'
+    if status_severity[status] < status_severity[previous_status]:
+        return 'improved'
+    return None
+
+# Labels added in front of the recommendation so the digest shows why a finding is listed
+finding_change_labels = {
+    'new' : "New: ",
+    'escalated' : "Escalated: ",
+    'improved' : "Improved: "
+}
+
+# Create the finding used to report that a warning or violation has been resolved
+def create_resolved_finding(user, key, previous_status):
+    return Finding('good', user, "Resolved (was " + previous_status + ")", key)
+
+# Run the rules for users whose findings could have changed since the last run, and return a Rules object whose results only
+# contain new, escalated, improved and resolved findings. The returned rules keep every user in the report
+# account_id is used to fill in the ARN of users that have been removed when auditing more than one account
+# cancelled is checked before the state is saved, an account that timed out leaves the state as it was
+def evaluate_delta_audit(users, store, account_id=None, cancelled=None):
+
+    today_day = get_epoch_day(datetime.now(timezone.utc).date())
+    settings_fingerprint = get_settings_fingerprint()
+    settings_changed = store.get_setting('fingerprint') != settings_fingerprint
+
+    # Work out which users need to be evaluated, anything left in previous_users afterwards is no longer in the report
+    previous_users = store.load_users()
+    changed_users = []
+    for user in users:
+        previous_user = previous_users.pop(user.Username, None)
+        if settings_changed or previous_user is None or previous_user[0] != user.RowHash or today_day >= previous_user[1]:
+            changed_users.append(user)
+    removed_usernames = list(previous_users)
+
+    print("Delta audit - evaluating {} of {} users ({} removed)".format(len(changed_users), len(users), len(removed_usernames)))
+
+    results = Rules(changed_users).evaluate_rules()
+    previous_findings = store.load_findings()
+
+    delta_results = {rule: [] for rule in results}
+    next_change_days = {}
+    current_findings = {}
+    finding_states = []
+
+    for rule, findings in results.items():
+        for finding in findings:
+            username = finding.User.Username
+            key_id = finding.Key.KeyID if finding.Key is not None else ''
+            current_findings.setdefault(username, set()).add((rule, key_id))
+            finding_states.append((username, rule, key_id, finding.Status))
+
+            # Track the soonest day any of the user's findings could change status
+            days_until_change = get_days_until_change(rule, finding)
+            if days_until_change is not None:
+                next_change_days[username] = min(next_change_days.get(username, never_changes_day), today_day + days_until_change)
+
+            previous_status = previous_findings.get(username, {}).get((rule, key_id))
+            change = get_finding_change(previous_status, finding.Status)
+            if change == 'resolved':
+                delta_results[rule].append(create_resolved_finding(finding.User, finding.Key, previous_status))
+            elif change is not None:
+                finding.Recommendation = finding_change_labels[change] + finding.Recommendation
+                delta_results[rule].append(finding)
+
+    # Warnings and violations that no longer have a finding (key inactivated, console access removed or user deleted) are resolved
+    evaluated_users = {user.Username: user for user in changed_users}
+    for username in list(evaluated_users) + removed_usernames:
+        for (rule, key_id), previous_status in previous_findings.get(username, {}).items():
+            if previous_status == 'good' or (rule, key_id) in current_findings.get(username, ()):
+                continue
+            user = evaluated_users.get(username)
+            if user is None:
+                user = User(username, None if account_id is None else 'arn:aws:iam::' + account_id + ':user/' + username)
+            key = Key(key_id) if rule in key_rules else None
+            delta_results[rule].append(create_resolved_finding(user, key, previous_status))
 
-    # Rule to check when a users keys were last rotated
-    def generate_key_rotation_rows(self):
-        
-        temp_list =  []
+    user_states = [(user.Username, user.RowHash, next_change_days.get(user.Username, never_changes_day)) for user in changed_users]
+    check_cancelled(cancelled)
+    store.save(settings_fingerprint, user_states, finding_states, removed_usernames)
 
-        # Loop through each user and run their account agaisnt the thresholds. Generate a HTML row as output
-        for user in self.Users:
-            
-            # Default Values
-            status='good'
-            threshold_cell = None
-            recommendation = None
+    # The access levels table and the report counts cover every user in the report, only the findings are the delta
+    rules = Rules(users)
+    rules.Results = delta_results
+    return rules
 
-            # Loop through each key on a users account
-            for key in user.Keys:
-                
-                # If key isn't active then don't run an audit on it
-                if key.Active == 'false':
+# Live key refresh
+# -------------------- #
+# The credentials report can be up to 4 hours old, so a key flagged as inactive may have been used since the report was generated
+# When refresh_flagged_keys is set, keys with an inactive key warning or violation are checked against IAM before the digest is built
+# The calls go through a shared rate limit that slows down when IAM throttles, and stop once the call budget or time budget runs out
+
+# Raised when a call would go over the call or time budget
+class CallBudgetExceeded(Exception):
+    pass
+
+# Runs AWS calls from several threads through a token bucket, within a fixed number of calls and a deadline
+# The bucket holds up to burst tokens and refills at rate tokens a second. The rate is halved each time a call is throttled
+# and climbs back towards the starting rate as calls succeed
+class RateLimitedCaller(object):
+    def __init__(self, rate, max_calls, timeout, burst=1):
+        self.Lock = threading.Lock()
+        self.MaxRate = rate
+        self.Rate = rate
+        self.Burst = burst
+        self.Tokens = burst
+        self.Refilled = time.monotonic()
+        self.CallsLeft = max_calls
+        self.Deadline = time.monotonic() + timeout
+        self.Calls = 0
+        self.Throttles = 0
+
+    # Take a token, waiting for one to be refilled if the bucket is empty. Raises CallBudgetExceeded if there isn't one within the budget
+    def acquire(self):
+        with self.Lock:
+            now = time.monotonic()
+            self.Tokens = min(self.Burst, self.Tokens + (now - self.Refilled) * self.Rate)
+            self.Refilled = now
+            # The token can be taken ahead of time (the count goes negative), the caller waits until it would have been refilled
+            wait = max(0.0, (1 - self.Tokens) / self.Rate)
+            if self.CallsLeft <= 0 or now + wait > self.Deadline:
+                raise CallBudgetExceeded()
+            self.Tokens -= 1
+            self.CallsLeft -= 1
+            self.Calls += 1
+        time.sleep(wait)
+
+    def call(self, function, **kwargs):
+        delay = 0.5
+        while True:
+            self.acquire()
+            try:
+                response = function(**kwargs)
+            except Exception as error:
+                if not is_throttling_error(error):
+                    raise
+                with self.Lock:
+                    self.Throttles += 1
+                    self.Rate = max(self.MaxRate / 16, self.Rate / 2)
+                # Back off before trying again, the retry still has to fit in the budget
+                time.sleep(random.uniform(delay / 2, delay))
+                delay = min(delay * 2, 8.0)
+                continue
+            with self.Lock:
+                self.Rate = min(self.MaxRate, self.Rate + self.MaxRate / 10)
+            return response
+
+# Match the keys from the report to the keys IAM returns by their creation date, the report's last rotated date is when
+# the key was created. Only these matches are used for anything that changes a key
+def match_access_keys_exactly(user, access_keys):
+    matches = {}
+    for key in user.Keys:
+        if key.LastRotated is None:
+            continue
+        for access_key in access_keys:
+            if abs((access_key['CreateDate'] - key.LastRotated).total_seconds()) < 1:
+                matches[key.KeyID] = access_key
+    return matches
+
+# Match the keys from the report to the keys IAM returns, keys that can't be matched by their creation date are matched
+# by age (the report lists the older key first). This is a guess, so it's only used to refresh what the report shows
+def match_access_keys(user, access_keys):
+    access_keys = sorted(access_keys, key=lambda access_key: access_key['CreateDate'])
+    matches = match_access_keys_exactly(user, access_keys)
+    unmatched = [access_key for access_key in access_keys if access_key not in matches.values()]
+    for key in user.Keys:
+        if key.KeyID not in matches and key.Active and unmatched:
+            matches[key.KeyID] = unmatched.pop(0)
+    return matches
+
+# Get the current status and last used date of the user's flagged keys from IAM and update the keys
+# Returns the number of keys that changed
+def refresh_user_keys(caller, client, user, keys):
+    access_keys = caller.call(client.list_access_keys, UserName=user.Username)['AccessKeyMetadata']
+    matches = match_access_keys(user, access_keys)
+    changed = 0
+    for key in keys:
+        access_key = matches.get(key.KeyID)
+
+        # The key was deleted or deactivated after the report was generated, it's no longer checked by the rules
+        if access_key is None or access_key['Status'] != 'Active':
+            key.Active = False
+            changed += 1
+            continue
+
+        last_used = caller.call(client.get_access_key_last_used, AccessKeyId=access_key['AccessKeyId'])['AccessKeyLastUsed']
+        last_used_date = last_used.get('LastUsedDate')
+        if last_used_date is not None and (key.LastUsed is None or last_used_date > key.LastUsed):
+            key.LastUsed = last_used_date
+            key.RegionLastUsed = last_used.get('Region', key.RegionLastUsed)
+            key.ServiceLastUsed = last_used.get('ServiceName', key.ServiceLastUsed)
+            changed += 1
+    return changed
+
+# Refresh every key with an inactive key warning or violation, returns the number of keys that changed
+def refresh_flagged_keys(session, users):
+    config = get_config()
+
+    # Find the flagged keys with a quick evaluation of the report as it is
+    flagged = {}
+    for finding in select_findings(Rules(users).evaluate_rules()['inactive_keys'], ('warning', 'violation')):
+        flagged.setdefault(finding.User.Username, (finding.User, []))[1].append(finding.Key)
+    if not flagged:
+        return 0
+
+    start = time.monotonic()
+    client = get_boto_client(session, 'iam')
+    caller = RateLimitedCaller(config.key_refresh_rate, config.key_refresh_max_calls, config.key_refresh_timeout)
+    changed = 0
+    skipped = 0
+    failed = 0
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.key_refresh_max_workers)
+    try:
+        futures = {executor.submit(refresh_user_keys, caller, client, user, keys): user for user, keys in flagged.values()}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                user_changed = future.result()
+                # Clear the row hash of users whose keys changed so a delta audit evaluates them again
+                if user_changed:
+                    futures[future].RowHash = None
+                changed += user_changed
+            except CallBudgetExceeded:
+                skipped += 1
+            except Exception as error:
+                failed += 1
+                print("Key refresh failed : " + repr(error))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    print("Key refresh - {} flagged users, {} keys changed, {} users skipped (budget), {} failed, {} calls, {} throttled, {:.3f}s".format(len(flagged), changed, skipped, failed, caller.Calls, caller.Throttles, time.monotonic() - start))
+    run_metrics.add_phase('KeyRefresh', time.monotonic() - start)
+    run_metrics.add_count('KeyRefreshCalls', caller.Calls)
+    return changed
+
+# Auto remediation
+# -------------------- #
+# When remediation_mode is dry_run or apply the Lambda acts on violations of the rules in remediation_rules :
+# inactive_keys violations have the key set to Inactive (update_access_key), inactive_users violations have their console
+# password removed (delete_login_profile). Only users on remediation_allow_list and not on remediation_exempt_list are touched
+# dry_run only logs the plan. Every action is written to the log and to remediation_log_path as one JSON line
+
+# Action taken for a violation of each rule
+remediation_actions = {
+    'inactive_keys' : 'inactivate_key',
+    'inactive_users' : 'remove_console_access'
+}
+
+# Label added to the recommendation of a finding that was (or would be) remediated
+remediation_labels = {
+    'dry_run' : "Planned: ",
+    'apply' : "Remediated: "
+}
+
+# Check if a user matches a list of usernames and IAM path prefixes (entries starting with /)
+def matches_user_list(user, entries):
+    path = '/' + '/'.join(get_path_segments(user.ARN)) + '/'
+    path = path.replace('//', '/')
+    for entry in entries:
+        if entry.startswith('/'):
+            if path.startswith(entry if entry.endswith('/') else entry + '/'):
+                return True
+        elif entry == user.Username:
+            return True
+    return False
+
+# Get the violations that should be remediated, as (rule, finding) in the order they're in the digest
+def get_remediation_plan(rules, config):
+    plan = []
+    for rule in config.remediation_rules:
+        if rule not in remediation_actions:
+            raise ValueError("Rule " + rule + " can't be remediated, use one of " + ', '.join(remediation_actions))
+        for finding in select_findings(rules.evaluate_rules()[rule], ('violation',)):
+            if not matches_user_list(finding.User, config.remediation_allow_list) or matches_user_list(finding.User, config.remediation_exempt_list):
+                continue
+            plan.append((rule, finding))
+    return plan
+
+# Set a flagged key to Inactive, returns the result for the audit log, the access key ID and the reason a key was skipped
+# Keys that are already inactive aren't touched again. The key is only changed when it can be matched to the report by its
+# creation date, a key that was replaced since the report was generated is left alone
+# The report can be hours old, so the key's last use is checked with IAM right before it's changed. A key that's been used
+# since, or that can't be checked, is skipped
+def inactivate_key(caller, client, finding):
+    matches = match_access_keys_exactly(finding.User, caller.call(client.list_access_keys, UserName=finding.User.Username)['AccessKeyMetadata'])
+    access_key = matches.get(finding.Key.KeyID)
+    if access_key is None:
+        return 'not_found', None, None
+    if access_key['Status'] != 'Active':
+        return 'already_done', access_key['AccessKeyId'], None
+
+    try:
+        last_used = caller.call(client.get_access_key_last_used, AccessKeyId=access_key['AccessKeyId'])['AccessKeyLastUsed']
+    except CallBudgetExceeded:
+        raise
+    except Exception as error:
+        return 'skipped', access_key['AccessKeyId'], "last use couldn't be checked : " + repr(error)
+
+    # Keys that were never used count from when they were created, like the report's keys count from when the user was created
+    days_since_used = get_days_since_event(last_used.get('LastUsedDate') or access_key['CreateDate'])
+    high_threshold = get_rule_thresholds(finding.User)['inactive_keys'][1]
+    if days_since_used <= high_threshold:
+        return 'skipped', access_key['AccessKeyId'], "used {} day(s) ago, no longer a violation".format(days_since_used)
+
+    caller.call(client.update_access_key, UserName=finding.User.Username, AccessKeyId=access_key['AccessKeyId'], Status='Inactive')
+    return 'done', access_key['AccessKeyId'], None
+
+# Remove a user's console password, a user without one already has it removed
+# Like keys, the password's last use is checked with IAM right before it's removed. A user that's signed in since the report,
+# or that can't be checked, is skipped
+def remove_console_access(caller, client, finding):
+    try:
+        user = caller.call(client.get_user, UserName=finding.User.Username)['User']
+    except CallBudgetExceeded:
+        raise
+    except client.exceptions.NoSuchEntityException:
+        return 'not_found', None, None
+    except Exception as error:
+        return 'skipped', None, "last sign in couldn't be checked : " + repr(error)
+
+    # Passwords that were never used count from when the user was created, like the report does
+    days_since_used = get_days_since_event(user.get('PasswordLastUsed') or user['CreateDate'])
+    high_threshold = get_rule_thresholds(finding.User)['inactive_users'][1]
+    if days_since_used <= high_threshold:
+        return 'skipped', None, "signed in {} day(s) ago, no longer a violation".format(days_since_used)
+
+    try:
+        caller.call(client.delete_login_profile, UserName=finding.User.Username)
+    except client.exceptions.NoSuchEntityException:
+        return 'already_done', None, None
+    return 'done', None, None
+
+# Run the remediation for the violations in the digest, returns the audit log entries
+# plan_rules are the rules the violations are taken from when they aren't the digest's (a delta audit only has the findings
+# that changed, so the plan comes from every user). The digest's finding for a violation is labelled along with the plan's
+def remediate_violations(session, rules, account_id=None, plan_rules=None):
+    config = get_config()
+    if config.remediation_mode not in remediation_labels:
+        raise ValueError("remediation_mode has to be off, dry_run or apply, not " + config.remediation_mode)
+    plan = get_remediation_plan(rules if plan_rules is None else plan_rules, config)
+    if not plan:
+        return []
+
+    start = time.monotonic()
+    log_lock = threading.Lock()
+    entries = []
+
+    digest_findings = {}
+    if plan_rules is not None:
+        for rule in config.remediation_rules:
+            for finding in select_findings(rules.evaluate_rules()[rule], ('violation',)):
+                digest_findings[(rule, finding.User.Username, finding.Key.KeyID if finding.Key is not None else None)] = finding
+
+    def label_finding(rule, finding, label):
+        finding.Recommendation = label + finding.Recommendation
+        digest_finding = digest_findings.get((rule, finding.User.Username, finding.Key.KeyID if finding.Key is not None else None))
+        if digest_finding is not None and digest_finding is not finding:
+            digest_finding.Recommendation = label + digest_finding.Recommendation
+
+    def write_entry(rule, finding, result, access_key_id=None, error=None):
+        entry = {
+            'time' : datetime.now(timezone.utc).isoformat(),
+            'mode' : config.remediation_mode,
+            'account' : account_id or get_account_id_from_arn(finding.User.ARN or ''),
+            'user' : finding.User.Username,
+            'key' : finding.Key.KeyID if finding.Key is not None else None,
+            'access_key_id' : access_key_id,
+            'action' : remediation_actions[rule],
+            'result' : result,
+            'error' : error
+        }
+        line = json.dumps(entry, separators=(',', ':'))
+        with log_lock:
+            entries.append(entry)
+            print("Remediation " + line)
+            if config.remediation_log_path:
+                with open(config.remediation_log_path, 'a') as log_file:
+                    log_file.write(line + '\n')
+
+    # A dry run only writes the plan, nothing is called
+    if config.remediation_mode == 'dry_run':
+        for rule, finding in plan:
+            write_entry(rule, finding, 'planned')
+            label_finding(rule, finding, remediation_labels['dry_run'])
+        return entries
+
+    client = get_boto_client(session, 'iam')
+    caller = RateLimitedCaller(config.remediation_rate, config.remediation_max_calls, config.remediation_timeout, config.remediation_burst)
+    functions = {'inactivate_key' : inactivate_key, 'remove_console_access' : remove_console_access}
+
+    def run_action(rule, finding):
+        try:
+            result, access_key_id, reason = functions[remediation_actions[rule]](caller, client, finding)
+        except CallBudgetExceeded:
+            write_entry(rule, finding, 'skipped', error="call budget exceeded")
+            return
+        except Exception as error:
+            write_entry(rule, finding, 'failed', error=repr(error))
+            return
+        write_entry(rule, finding, result, access_key_id, reason)
+        if result in ('done', 'already_done'):
+            label_finding(rule, finding, remediation_labels['apply'])
+
+    # Each action only runs once per run, even if the same key or user shows up twice
+    actions = {}
+    for rule, finding in plan:
+        actions.setdefault((rule, finding.User.Username, finding.Key.KeyID if finding.Key is not None else None), (rule, finding))
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.remediation_max_workers)
+    try:
+        for future in [executor.submit(run_action, rule, finding) for rule, finding in actions.values()]:
+            future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    results = {}
+    for entry in entries:
+        results[entry['result']] = results.get(entry['result'], 0) + 1
+    print("Remediation - {} actions ({}), {} calls, {} throttled, {:.3f}s".format(len(actions), ', '.join(name + ' ' + str(count) for name, count in sorted(results.items())), caller.Calls, caller.Throttles, time.monotonic() - start))
+    run_metrics.add_phase('Remediation', time.monotonic() - start)
+    run_metrics.add_count('RemediationActions', results.get('done', 0))
+    return entries
+
+# Multi account audit
+# -------------------- #
+# Assumes a role in each account listed in audit_role_arns, audits the accounts at the same time on a bounded thread pool
+# and merges the findings into a single digest
+
+# Raised inside an account's audit once it has timed out, so its thread stops before changing state or remediating
+class AccountAuditCancelled(Exception):
+    pass
+
+# Stop an account's audit if cancelled (a threading.Event) has been set
+def check_cancelled(cancelled):
+    if cancelled is not None and cancelled.is_set():
+        raise AccountAuditCancelled()
+
+# Results of auditing one account
+class AccountAudit(object):
+    def __init__(self, account_id, rules, password_policies):
+        self.AccountId = account_id
+        self.Rules = rules
+        self.PasswordPolicies = password_policies
+
+# Get the account ID out of a role ARN (arn:aws:iam::<account id>:role/<name>)
+def get_account_id_from_arn(arn):
+    return arn.split(':')[4]
+
+# Get the list of role ARNs to audit, from the lambda event if it has them, otherwise from the audit_role_arns setting
+# The event can list the roles or give them as a comma separated string like the setting
+def get_audit_role_arns(event):
+    if isinstance(event, dict) and event.get('audit_role_arns'):
+        role_arns = event['audit_role_arns']
+        if isinstance(role_arns, str):
+            return list(parse_list(role_arns))
+        return list(role_arns)
+    return list(get_config().audit_role_arns)
+
+# Assume the role and create a boto session that uses its temporary credentials
+def create_assumed_role_session(session, role_arn):
+    import boto3
+
+    client = get_boto_client(session, 'sts')
+    response = client.assume_role(RoleArn=role_arn, RoleSessionName=get_config().audit_role_session_name)
+    credentials = response['Credentials']
+    return boto3.session.Session(
+        aws_access_key_id=credentials['AccessKeyId'],
+        aws_secret_access_key=credentials['SecretAccessKey'],
+        aws_session_token=credentials['SessionToken'],
+        region_name=session.region_name
+    )
+
+# Path of the delta audit state database, each account audited gets its own database
+def get_delta_state_path(account_id=None):
+    delta_state_path = get_config().delta_state_path
+    if account_id is None:
+        return delta_state_path
+    path_root, path_extension = os.path.splitext(delta_state_path)
+    return path_root + '-' + account_id + path_extension
+
+# Run the rules against an account's users, or only the changes since the last run when delta_audit is on
+# session is used to refresh flagged keys and remediate violations when those are turned on
+# cancelled is set when the account's audit times out, the refresh, the delta state and the remediation are skipped from then on
+def evaluate_account_rules(users, account_id=None, session=None, cancelled=None):
+    if session is not None and get_config().refresh_flagged_keys:
+        check_cancelled(cancelled)
+        refresh_flagged_keys(session, users)
+
+    start = time.monotonic()
+    if get_config().delta_audit:
+        store = StateStore(get_delta_state_path(account_id))
+        try:
+            rules = evaluate_delta_audit(users, store, account_id, cancelled)
+        finally:
+            store.close()
+    else:
+        rules = Rules(users)
+        rules.evaluate_rules()
+    run_metrics.add_phase('Rules', time.monotonic() - start)
+
+    # Remediated violations stay in the digest with their recommendation labelled
+    if session is not None and get_config().remediation_mode != 'off':
+        # A delta audit's results only have the findings that changed, so the plan is built from every user. Violations that
+        # are still open (skipped or failed last time, or from before remediation was turned on) are acted on again
+        plan_rules = Rules(users) if get_config().delta_audit else None
+        check_cancelled(cancelled)
+        remediate_violations(session, rules, account_id, plan_rules)
+    return rules
+
+# Audit a single account through an assumed role, cancelled is a threading.Event set when the audit times out
+def audit_account(session, role_arn, session_factory, cancelled=None):
+    account_id = get_account_id_from_arn(role_arn)
+    account_session = session_factory(session, role_arn)
+
+    # The report cache lives in the account running the lambda, so it's reached with the lambda's own session
+    users, password_policies = get_users_and_password_policies(account_session, account_id, session)
+
+    return AccountAudit(account_id, evaluate_account_rules(users, account_id, account_session, cancelled), password_policies)
+
+# Audit every account on a thread pool. Accounts that fail or take longer than audit_account_timeout are left out of the digest
+# session_factory creates the session for each role and can be swapped out to run against stubbed clients
+def audit_accounts(session, role_arns, session_factory=create_assumed_role_session):
+    
+    audits = []
+    failures = []
+    start_times = {}
+
+    # Accounts that time out have their event set, so their threads stop before refreshing keys, saving the delta state or remediating
+    cancel_events = {role_arn: threading.Event() for role_arn in role_arns}
+
+    # Record when each account actually starts, accounts waiting in the queue shouldn't use up their timeout
+    def run_audit(role_arn):
+        start_times[role_arn] = time.monotonic()
+        return audit_account(session, role_arn, session_factory, cancel_events[role_arn])
+
+    config = get_config()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.audit_max_workers)
+    try:
+        pending = {executor.submit(run_audit, role_arn): role_arn for role_arn in role_arns}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, timeout=0.5, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                role_arn = pending.pop(future)
+                try:
+                    audit = future.result()
+                except Exception as error:
+                    failures.append((role_arn, repr(error)))
                     continue
-                
-                days_since_last_rotated = 0
-                # Check when / if the user has ever used their password
-                if key.LastRotated == None:
-                    days_since_last_rotated = get_days_since_event(user.UserCreation)
-                else:
-                    days_since_last_rotated = get_days_since_event(key.LastRotated)
-
-                # Run audit for inactive users
-                if days_since_last_rotated < key_age_low:
-                    status = 'good'
-                    threshold_cell = threshold_cell_good
-                    recommendation = "None"
-                elif days_since_last_rotated >=  key_age_low and days_since_last_rotated <= key_age_high:
-                    status ='warning'
-                    threshold_cell = threshold_cell_warning
-                    recommendation = "Rotate key soon or determine if needed"
-                else:
-                    status='violation'
-                    threshold_cell = threshold_cell_violation
-                    recommendation = "Rotate or inactivate immediately"
-
-                # Row template
-                temp = '''<tr align="center">
-                    '''+ threshold_cell +'''
-                    <td>'''+ user.Username +'''</td>
-                    <td>'''+ key.KeyID +'''</td>
-                    <td>'''+ recommendation +'''</td>
-                </tr>'''
-
-                # If user has display_actionable_only set to true then only write warning and violation records
-                if display_actionable_only == 'True' and status != 'good' or display_actionable_only == 'False' :
-                    # Add row to list 
-                    temp_list.append(temp)
-
-        # Concat all rows into one string to drop into the template 
-        return ''.join(temp_list)
+                print("Account {} - {:.3f}s".format(audit.AccountId, time.monotonic() - start_times[role_arn]))
+                audits.append(audit)
+
+            # Give up on any account that has been running for longer than the timeout
+            now = time.monotonic()
+            for future, role_arn in list(pending.items()):
+                if role_arn in start_times and now - start_times[role_arn] > config.audit_account_timeout:
+                    future.cancel()
+                    cancel_events[role_arn].set()
+                    pending.pop(future)
+                    failures.append((role_arn, "timed out after " + str(config.audit_account_timeout) + " seconds"))
+    finally:
+        # Don't wait on accounts that timed out, their threads stop at the next check in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    for role_arn, error in failures:
+        print("Account audit failed for " + role_arn + " : " + error)
+
+    if not audits:
+        raise RuntimeError("All " + str(len(role_arns)) + " account audits failed")
+
+    # Keep the digest in the same order as the list of roles
+    role_order = {get_account_id_from_arn(role_arn): index for index, role_arn in enumerate(role_arns)}
+    audits.sort(key=lambda audit: role_order[audit.AccountId])
+    return audits
+
+# Merge the account audits into one set of rules for the digest, usernames are shown with their account ID
+def merge_account_audits(audits):
+    users = []
+    results = {}
+    for audit in audits:
+        users.extend(audit.Rules.Users)
+        for rule, findings in audit.Rules.Results.items():
+            results.setdefault(rule, []).extend(findings)
+
+    rules = Rules(users)
+    rules.Results = results
+    rules.ShowAccount = True
+    return rules
+
+# Merge the password policies of each account, each value is listed with the account it came from
+def merge_password_policies(audits):
+    merged_policy = {}
+    for field in password_policy_template_fields.values():
+        values = [audit.AccountId + ': ' + str(audit.PasswordPolicies["PasswordPolicy"].get(field, '-')) for audit in audits]
+        merged_policy[field] = '<br/>'.join(values)
+    return {"PasswordPolicy": merged_policy}
 
 class Email(object):
 
-    def generate_template_data(self,session,rules):
+    # password_policies can be passed in when they have already been fetched (ex. merged from several accounts)
+    def generate_template_data(self,session,rules,password_policies=None):
         html_email_template_data = {}
         # Add date formatting for the report header to the template data 
         html_email_template_data['Date'] = rules.get_today_date_formatted()
+        # Filled in with "Part 1 of 3" when the report is too big for one email and has to be split
+        html_email_template_data['Part'] = ''
         
         # Populate and add the Access Table content to the template data
-        html_email_template_data['AccessTableRows'] = rules.generate_access_level_rows()
+        config = get_config()
+        if config.structured_template_data:
+            html_email_template_data['AccessTableRows'] = rules.generate_access_level_data()
+        else:
+            html_email_template_data['AccessTableRows'] = rules.generate_access_level_rows()
 
         # Populate and add Password Policies to the template data
-        password_policies =  get_account_password_policies(session)
-        html_email_template_data['password-policy-min-pass-length'] = password_policies["PasswordPolicy"]["MinimumPasswordLength"]
-        html_email_template_data['password-policy-require-symbols'] = password_policies["PasswordPolicy"]["RequireSymbols"]
-        html_email_template_data['password-policy-require-numbers'] = password_policies["PasswordPolicy"]["RequireNumbers"]
-        html_email_template_data['password-policy-require-uppercase'] = password_policies["PasswordPolicy"]["RequireUppercaseCharacters"]
-        html_email_template_data['password-policy-require-lowercase'] = password_policies["PasswordPolicy"]["RequireLowercaseCharacters"]
-        html_email_template_data['password-policy-users-change-passwords'] = password_policies["PasswordPolicy"]["AllowUsersToChangePassword"]
-        html_email_template_data['password-policy-expire-passwords'] = password_policies["PasswordPolicy"]["ExpirePasswords"]
-        html_email_template_data['password-policy-password-age'] = password_policies["PasswordPolicy"]["MaxPasswordAge"]
-        html_email_template_data['password-policy-password-reuse'] = password_policies["PasswordPolicy"]["PasswordReusePrevention"]
-        html_email_template_data['password-policy-hard-expire'] = password_policies["PasswordPolicy"]["HardExpiry"]
+        if password_policies is None:
+            password_policies =  get_account_password_policies(session)
+        # Fields the account hasn't set (or every field when there is no password policy) are shown as -
+        for template_field, policy_field in password_policy_template_fields.items():
+            html_email_template_data[template_field] = password_policies["PasswordPolicy"].get(policy_field, '-')
         
         # Populate and add the Rules Threshold content to the template data
         # Check if we are checking for MFA and write proper content to the theshold table
-        if check_mfa == 'True':
+        if config.check_mfa:
             html_email_template_data['MFAGood'] = "True"
             html_email_template_data['MFAViolation'] = "False"
         else:
             html_email_template_data['MFAGood'] = "-"
             html_email_template_data['MFAViolation'] = "-"
 
-        html_email_template_data['InactiveUsersLow'] = inactive_user_low
-        html_email_template_data['InactiveUsersHigh'] = inactive_user_high
-        html_email_template_data['PasswordRotationLow'] = password_age_low
-        html_email_template_data['PasswordRotationHigh'] = password_age_high
-        html_email_template_data['InactiveKeysLow'] = inactive_key_low
-        html_email_template_data['InactiveKeysHigh'] = inactive_key_high
-        html_email_template_data['KeyRotationLow'] = key_age_low
-        html_email_template_data['KeyRotationHigh'] = key_age_high
+        html_email_template_data['InactiveUsersLow'] = config.inactive_user_low
+        html_email_template_data['InactiveUsersHigh'] = config.inactive_user_high
+        html_email_template_data['PasswordRotationLow'] = config.password_age_low
+        html_email_template_data['PasswordRotationHigh'] = config.password_age_high
+        html_email_template_data['InactiveKeysLow'] = config.inactive_key_low
+        html_email_template_data['InactiveKeysHigh'] = config.inactive_key_high
+        html_email_template_data['KeyRotationLow'] = config.key_age_low
+        html_email_template_data['KeyRotationHigh'] = config.key_age_high
 
         # Run rules, generate content for rules tables. Add content to template data to push to HTML Template
+        # Structured rows are rendered by the {{#each}} blocks in AIRL-SecurityReport-EmailTemplate-Structured.html
+        if config.structured_template_data:
+            html_email_template_data['MFATableRows'] = rules.generate_finding_data('mfa', False)
+            html_email_template_data['InactiveUsersTableRows'] = rules.generate_finding_data('inactive_users', False)
+            html_email_template_data['PasswordRotationTableRows'] = rules.generate_finding_data('password_rotation', False)
+            html_email_template_data['InactiveKeysTableRows'] = rules.generate_finding_data('inactive_keys', True)
+            html_email_template_data['KeyRotationTableRows'] = rules.generate_finding_data('key_rotation', True)
+            return json.dumps(html_email_template_data, separators=(',', ':'))
+
         html_email_template_data['MFATableRows'] = rules.generate_mfa_enabled_rows()
         html_email_template_data['InactiveUsersTableRows'] = rules.generate_inactive_users_rows()
         html_email_template_data['PasswordRotationTableRows'] = rules.generate_password_rotation_rows()
@@ -562,44 +2549,284 @@ class Email(object):
     # Send data for the report generated from the program to the HTML Template, then SES will email out to desired recipents
     def send_templated_email_report(self,session,template_data):
         
-        recipent_email_address=[os.environ['recipent_email_address']]
-        ses_source_email = os.environ['ses_source_email']
-        ses_template_name = os.environ['ses_template_name']
+        config = get_config()
+        recipent_email_address=[config.recipent_email_address]
+        ses_source_email = config.ses_source_email
+        ses_template_name = config.ses_template_name
 
         # Create boto client for SES
-        client = session.client(service_name='ses')
+        client = get_boto_client(session, 'ses')
+
+        # Split the report into several emails when the template data is bigger than SES will take in one request
+        parts = split_template_data(template_data, config.ses_max_template_data_bytes)
 
         # Send data to SES with the templated email service, this will will take this data, populate it into the HTML template and email it to recipents
-        client.send_templated_email(
-        Source= ses_source_email,
-        Destination={
-            'ToAddresses': recipent_email_address
-        },
-        Template=ses_template_name,
-        TemplateData=template_data
-        )
-        
+        def send_part(part):
+            start = time.monotonic()
+            attempts = send_with_retries(client.send_templated_email, config.ses_send_max_attempts,
+            Source= ses_source_email,
+            Destination={
+                'ToAddresses': recipent_email_address
+            },
+            Template=ses_template_name,
+            TemplateData=part
+            )
+            return attempts, time.monotonic() - start
+
+        run_metrics.add_count('EmailParts', len(parts))
+        if len(parts) == 1:
+            send_part(parts[0])
+            return
+
+        # Parts are numbered in their template data so they can be sent at the same time, SES throttling is handled by the retries
+        failures = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=config.ses_send_max_workers) as executor:
+            futures = [executor.submit(send_part, part) for part in parts]
+            for number, (part, future) in enumerate(zip(parts, futures), 1):
+                try:
+                    attempts, elapsed = future.result()
+                except Exception as error:
+                    failures.append(number)
+                    print("Part {} of {} - {} bytes, failed : {!r}".format(number, len(parts), len(part.encode('utf-8')), error))
+                    continue
+                print("Part {} of {} - {} bytes, {:.3f}s, {} attempt(s)".format(number, len(parts), len(part.encode('utf-8')), elapsed, attempts))
+
+        if failures:
+            raise RuntimeError("Failed to send part(s) " + ', '.join(str(number) for number in failures) + " of " + str(len(parts)))
+
+# Splitting large reports
+# -------------------- #
+# Template data fields that hold table rows, parts are filled in this order so the tables stay in the same order as a single email
+template_table_fields = ('AccessTableRows', 'MFATableRows', 'InactiveUsersTableRows', 'PasswordRotationTableRows', 'InactiveKeysTableRows', 'KeyRotationTableRows')
+
+# Every rendered row starts with the same tag, usernames are escaped so it can't show up inside a row
+table_row_start = '<tr align="center">'
+
+# Split a table into rows, structured tables are already a list and HTML tables are split on the start of each row
+def split_table_rows(value):
+    if isinstance(value, list):
+        return value
+    return [table_row_start + row for row in value.split(table_row_start)[1:]]
+
+# Join rows back into a table the same way they were sent
+def join_table_rows(rows, structured):
+    if structured:
+        return rows
+    return ''.join(rows)
+
+# Split the template data into parts that are each under the size budget
+# Returns the template data unchanged in a list of one when it already fits
+def split_template_data(template_data, budget):
+    if len(template_data.encode('utf-8')) <= budget:
+        return [template_data]
+
+    data = json.loads(template_data)
+    structured = isinstance(data['AccessTableRows'], list)
+    separators = (',', ':') if structured else None
+
+    # Size of the data that's repeated in every part (date, password policies, thresholds, empty tables and the part label)
+    base = dict(data)
+    base['Part'] = 'Part 0000 of 0000'
+    for field in template_table_fields:
+        base[field] = join_table_rows([], structured)
+    base_size = len(json.dumps(base, separators=separators).encode('utf-8'))
+
+    # Fill each part with rows until the next one would go over the budget, a part always gets at least one row
+    parts = []
+    current = {field: [] for field in template_table_fields}
+    current_size = base_size
+    current_rows = 0
+    for field in template_table_fields:
+        for row in split_table_rows(data[field]):
+            row_size = len(json.dumps(row, separators=separators).encode('utf-8'))
+            # Structured rows also need a comma, HTML rows are joined into the string so the quotes aren't repeated
+            row_size = row_size + 1 if structured else row_size - 2
+            if current_rows and current_size + row_size > budget:
+                parts.append(current)
+                current = {field: [] for field in template_table_fields}
+                current_size = base_size
+                current_rows = 0
+            current[field].append(row)
+            current_size += row_size
+            current_rows += 1
+    parts.append(current)
+
+    rendered = []
+    for number, tables in enumerate(parts, 1):
+        part = dict(data)
+        part['Part'] = 'Part ' + str(number) + ' of ' + str(len(parts))
+        for field in template_table_fields:
+            part[field] = join_table_rows(tables[field], structured)
+        rendered.append(json.dumps(part, separators=separators))
+    return rendered
+
+# Error codes SES and the other AWS services use when a request is throttled
+throttling_error_codes = frozenset(('Throttling', 'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded'))
+
+def is_throttling_error(error):
+    response = getattr(error, 'response', None)
+    return isinstance(response, dict) and response.get('Error', {}).get('Code') in throttling_error_codes
+
+# Call an AWS api, retrying with a jittered exponential backoff while the request is throttled. Returns the number of attempts
+# botocore already retries each attempt (client_max_attempts), this covers throttling that lasts longer than those retries
+def send_with_retries(function, max_attempts, **kwargs):
+    delay = 1.0
+    for attempt in range(1, max_attempts + 1):
+        try:
+            function(**kwargs)
+            return attempt
+        except Exception as error:
+            if attempt == max_attempts or not is_throttling_error(error):
+                raise
+        time.sleep(random.uniform(delay / 2, delay))
+        delay = min(delay * 2, 20.0)
+
+# Local template rendering
+# -------------------- #
+# Renders the SES email template without calling SES, used by SecurityAuditDigest-Local.py and the benchmarks
+# Supports the parts of the SES template syntax the report templates use : {{Name}} and {{#each Name}} ... {{/each}}
+# Values are written as-is like they are by SES today, the rows are already HTML and usernames are escaped when they're rendered
+
+template_tag = None
+
+# Convert a template data value into the text SES would write, JSON true/false are written in lowercase
+def format_template_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+# Template compiled into a plan : the literal text between the tags, and for each tag the field name and the compiled
+# body when the tag is an {{#each}} block. Rendering walks the plan once without searching the template again
+class CompiledTemplate(object):
+    __slots__ = ('Fragments', 'Fields', 'Blocks')
+
+    def __init__(self, fragments, fields, blocks):
+        self.Fragments = fragments
+        self.Fields = fields
+        self.Blocks = blocks
+
+    def render(self, data):
+        buffer = []
+        self.render_into(data, buffer)
+        return ''.join(buffer)
+
+    def render_into(self, data, buffer):
+        append = buffer.append
+        fragments = self.Fragments
+        for index, (field, block) in enumerate(zip(self.Fields, self.Blocks)):
+            append(fragments[index])
+            value = data.get(field)
+            if block is None:
+                append(format_template_value(value))
+            elif value:
+                for item in value:
+                    block.render_into(item, buffer)
+        append(fragments[-1])
+
+# Compile the text of an SES template, call this once and render the compiled template as many times as needed
+def compile_template(text):
+    global template_tag
+    if template_tag is None:
+        import re
+        template_tag = re.compile(r'\{\{\s*(#each\s+|/each\s*)?([^}]*?)\s*\}\}')
+
+    # Stack of the blocks that are open, each one collects its fragments, fields and child blocks
+    stack = [([], [], [], None)]
+    position = 0
+    for match in template_tag.finditer(text):
+        fragments, fields, blocks, _ = stack[-1]
+        fragments.append(text[position:match.start()])
+        position = match.end()
+        tag, name = match.group(1), match.group(2)
+        if tag is None:
+            fields.append(name)
+            blocks.append(None)
+        elif tag.startswith('#each'):
+            stack.append(([], [], [], name))
+        else:
+            if len(stack) == 1:
+                raise ValueError("Unexpected {{/each}} at position " + str(match.start()))
+            # The text before {{/each}} was added as the last fragment of the block
+            fragments, fields, blocks, name = stack.pop()
+            _, parent_fields, parent_blocks, _ = stack[-1]
+            parent_fields.append(name)
+            parent_blocks.append(CompiledTemplate(tuple(fragments), tuple(fields), tuple(blocks)))
+
+    if len(stack) != 1:
+        raise ValueError("{{#each " + stack[-1][3] + "}} is never closed")
+    fragments, fields, blocks, _ = stack[0]
+    fragments.append(text[position:])
+    return CompiledTemplate(tuple(fragments), tuple(fields), tuple(blocks))
+
+# Count the users, active keys and findings of each status in the digest
+def add_report_counts(metrics, rules):
+    metrics.add_count('Users', len(rules.Users))
+    metrics.add_count('ActiveKeys', sum(1 for user in rules.Users for key in user.Keys if key.Active))
+    status_counts = {}
+    for findings in rules.evaluate_rules().values():
+        for status, count in count_finding_statuses(findings).items():
+            status_counts[status] = status_counts.get(status, 0) + count
+    for status, count in status_counts.items():
+        metrics.add_count('Findings' + status.capitalize(), count)
+
+# Profile the whole run when profiler_phases includes handler
 def lambda_handler(event, context):
+    return run_profiled('handler', run_audit_digest, event, context)
+
+def run_audit_digest(event, context):
+    global run_metrics
+    run_metrics = RunMetrics()
     
+    start = time.monotonic()
     profile_name = None
-    region_name = os.environ["ses_region_name"]
+    region_name = get_config().ses_region_name
     
     # Create a session for Boto3 based on what info in provided by for the profile_name and/or region_name
     session = create_boto_session(profile_name,region_name)
 
-    # 1. Get Security File
-    content = get_iam_credentials_report(session)
-
-    # 2. Parse file into models
-    users = parse_report_to_models(content)
-
-    # 3. Check against rules
-    rules = Rules(users)
+    # When a list of roles is provided audit each of those accounts and merge them into one digest
+    role_arns = get_audit_role_arns(event)
+    password_policies = None
+    if role_arns:
+        audits = run_profiled('report', audit_accounts, session, role_arns)
+        rules = merge_account_audits(audits)
+        password_policies = merge_password_policies(audits)
+        run_metrics.add_count('Accounts', len(audits))
+    else:
+        # 1. Get Security File and 2. Parse file into models (both are skipped when the cached report is still current)
+        # The password policy is fetched at the same time
+        users, password_policies = run_profiled('report', get_users_and_password_policies, session)
+
+        # 3. Check against rules, a delta audit only keeps findings that changed since the last run
+        rules = run_profiled('rules', evaluate_account_rules, users, None, session)
 
     # 4 Send Templated Email
     email = Email()
     # Run the rules and generate the data that will be pushed to the template
-    template_data = email.generate_template_data(session,rules)
-    email.send_templated_email_report(session,template_data)
+    phase_start = time.monotonic()
+    template_data = run_profiled('template_data', email.generate_template_data, session, rules, password_policies)
+    run_metrics.add_phase('TemplateData', time.monotonic() - phase_start)
+    template_data_bytes = len(template_data.encode('utf-8'))
+    print("Template data - {} bytes".format(template_data_bytes))
+
+    phase_start = time.monotonic()
+    run_profiled('send', email.send_templated_email_report, session, template_data)
+    run_metrics.add_phase('Send', time.monotonic() - phase_start)
     
-    print("Operation ran sucessfully")
+    print("Client registry - {} hits, {} misses".format(client_registry_stats['hits'], client_registry_stats['misses']))
+    for line in run_metrics.format_call_summary():
+        print(line)
+    print("Operation ran sucessfully in {:.3f}s".format(time.monotonic() - start))
+
+    # Log the metrics for the run as one EMF line
+    config = get_config()
+    if config.emit_metrics:
+        run_metrics.add_phase('Total', time.monotonic() - start)
+        run_metrics.add_count('TemplateDataBytes', template_data_bytes)
+        add_report_counts(run_metrics, rules)
+        function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+        print(run_metrics.format_emf(config.metrics_namespace, function_name))
+        for line in run_metrics.format_call_emf(config.metrics_namespace, function_name):
+            print(line)